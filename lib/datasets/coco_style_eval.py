@@ -0,0 +1,239 @@
+# --------------------------------------------------------
+# COCO-style evaluation on a flat ground truth index
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import numpy as np
+
+from datasets.voc_eval import stack_detections
+from utils.bbox import bbox_overlaps
+
+COCO_IOU_THRESHOLDS = np.linspace(.5, .95, 10)
+COCO_RECALL_THRESHOLDS = np.linspace(.0, 1., 101)
+COCO_AREA_RANGES = [('all', 0, 1e10), ('small', 0, 32 ** 2), ('medium', 32 ** 2, 96 ** 2), ('large', 96 ** 2, 1e10)]
+
+
+def flatten_detections(all_boxes, classinds):
+  """
+  Converts the detections of an imdb to flat arrays
+  inputs:
+    all_boxes - all_boxes[class][image] is [] or an array of shape #dets x 5 (x1, y1, x2, y2, score)
+    classinds - the classes to take from all_boxes
+  returns:
+    image_ids, class_ids, scores, boxes - one entry per detection
+  """
+  image_ids, class_ids, scores, boxes = [], [], [], []
+  for classind in classinds:
+    cls_image_ids, cls_scores, cls_boxes = stack_detections(all_boxes[classind])
+    image_ids.append(cls_image_ids)
+    class_ids.append(np.full(len(cls_image_ids), classind, dtype=np.int32))
+    scores.append(cls_scores)
+    # stack_detections shifts to the 1-based results file convention, the roidb is 0-based
+    boxes.append(cls_boxes - 1)
+  return (np.concatenate([np.zeros(0, dtype=np.int64)] + image_ids),
+          np.concatenate([np.zeros(0, dtype=np.int32)] + class_ids),
+          np.concatenate([np.zeros(0)] + scores),
+          np.concatenate([np.zeros((0, 4))] + boxes))
+
+
+def candidate_pairs(boxes, det_offsets, gt_boxes, gt_offsets, min_iou):
+  """
+  Detection / object pairs of the same image with an IoU of at least min_iou
+  inputs:
+    boxes, gt_boxes - the detections and objects, both sorted by image
+    det_offsets, gt_offsets - the rows of image i are offsets[i]:offsets[i + 1]
+  returns:
+    pair_det, pair_gt, pair_iou - rows into boxes and gt_boxes and their IoU, grouped by image
+  """
+  pair_det, pair_gt, pair_iou = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+  images = np.nonzero((np.diff(det_offsets) > 0) & (np.diff(gt_offsets) > 0))[0]
+  for image in images:
+    d0, d1, g0, g1 = det_offsets[image], det_offsets[image + 1], gt_offsets[image], gt_offsets[image + 1]
+    ious = bbox_overlaps(boxes[d0:d1], gt_boxes[g0:g1])
+    dets, objects = np.nonzero(ious >= min_iou)
+    pair_det.append(dets + d0)
+    pair_gt.append(objects + g0)
+    pair_iou.append(ious[dets, objects])
+  return np.concatenate(pair_det), np.concatenate(pair_gt), np.concatenate(pair_iou)
+
+
+def match_detections(pair_det, pair_gt, pair_iou, ranks, gt_ignore, dt_out_of_range, iou_thresholds):
+  """
+  COCO matching of the detections of one class, for all images, area ranges and IoU thresholds at once.
+  Within an image every detection (in score order) takes the unmatched object with the highest IoU above the
+  threshold, objects that are not ignored in the area range are preferred. The detections of all images with the
+  same rank are matched together, they never compete for an object.
+  inputs:
+    pair_det, pair_gt, pair_iou - the candidate pairs of candidate_pairs
+    ranks - score rank of every detection within its image
+    gt_ignore - #areas x #objects, objects outside of the area range
+    dt_out_of_range - #areas x #dets, detections outside of the area range
+    iou_thresholds - the T IoU thresholds, ascending
+  returns:
+    dt_match, dt_ignore - #areas x T x #dets, matched detections and detections that do not count
+  """
+  nr_areas, nr_objects = gt_ignore.shape
+  nr_dets = len(ranks)
+  dt_match = np.zeros((nr_areas, len(iou_thresholds), nr_dets), dtype=bool)
+  dt_ignore = np.zeros((nr_areas, len(iou_thresholds), nr_dets), dtype=bool)
+  gt_matched = np.zeros((nr_areas, len(iou_thresholds), nr_objects), dtype=bool)
+  preference = 2. * ~gt_ignore
+
+  # pairs sorted by the rank of their detection, ties go to the lowest object like argmax
+  order = np.lexsort((pair_gt, pair_det, ranks[pair_det]))
+  pair_det, pair_gt, pair_iou = pair_det[order], pair_gt[order], pair_iou[order]
+  pair_ranks = ranks[pair_det]
+  rank_offsets = np.searchsorted(pair_ranks, np.arange(pair_ranks[-1] + 2 if len(order) > 0 else 1))
+  for start, end in zip(rank_offsets[:-1], rank_offsets[1:]):
+    if start == end:
+      continue
+    dets, objects, ious = pair_det[start:end], pair_gt[start:end], pair_iou[start:end]
+    seg_starts = np.nonzero(np.diff(dets, prepend=-1))[0]
+    seg_ids = np.cumsum(np.diff(dets, prepend=-1) != 0) - 1
+
+    free = (ious >= iou_thresholds[:, None]) & ~gt_matched[:, :, objects]
+    rating = np.where(free, ious + preference[:, None, objects], -1.)
+    best = np.maximum.reduceat(rating, seg_starts, axis=2)
+    winners = np.where((rating == best[:, :, seg_ids]) & (rating >= 0), np.arange(end - start), end - start)
+    winners = np.minimum.reduceat(winners, seg_starts, axis=2)
+
+    area_ind, thresh_ind, seg = np.nonzero(winners < end - start)
+    won = objects[winners[area_ind, thresh_ind, seg]]
+    gt_matched[area_ind, thresh_ind, won] = True
+    dt_match[area_ind, thresh_ind, dets[seg_starts[seg]]] = True
+    dt_ignore[area_ind, thresh_ind, dets[seg_starts[seg]]] = gt_ignore[area_ind, won]
+
+  dt_ignore |= ~dt_match & dt_out_of_range[:, None, :]
+  return dt_match, dt_ignore
+
+
+def coco_eval(gt_index, image_ids, class_ids, scores, boxes, classinds, max_dets=(1, 10, 100),
+              iou_thresholds=COCO_IOU_THRESHOLDS, area_ranges=COCO_AREA_RANGES):
+  """
+  COCO-style evaluation of flat detections against a GTIndex. The detections are sorted by class, image and score
+  once, every class is matched for all images, IoU thresholds and area ranges at once, the numbers of detections
+  per image are prefixes of the score ordered detections.
+  inputs:
+    gt_index - the GTIndex of the evaluated imdb
+    image_ids, class_ids, scores, boxes - one entry per detection, boxes in the coordinates of the roidb
+    classinds - the evaluated classes
+    max_dets - maximal numbers of detections per image
+    iou_thresholds, area_ranges - as in the COCO evaluation
+  returns:
+    precision - T x #recall thresholds x K x A x M, -1 where the class has no objects
+    recall - T x K x A x M, -1 where the class has no objects
+  """
+  iou_thresholds = np.asarray(iou_thresholds)
+  nr_thresh, nr_areas, nr_max_dets = len(iou_thresholds), len(area_ranges), len(max_dets)
+  precision = -np.ones((nr_thresh, len(COCO_RECALL_THRESHOLDS), len(classinds), nr_areas, nr_max_dets))
+  recall = -np.ones((nr_thresh, len(classinds), nr_areas, nr_max_dets))
+
+  area_lo = np.array([lo for _, lo, _ in area_ranges])[:, None]
+  area_hi = np.array([hi for _, _, hi in area_ranges])[:, None]
+  gt_image_ids = gt_index.image_ids()
+  image_range = np.arange(gt_index.num_images + 1)
+
+  # detections sorted by class, image and descending score, ties keep their input order
+  order = np.lexsort((-scores, image_ids, class_ids))
+  class_offsets = np.searchsorted(class_ids[order], [(c, c + 1) for c in classinds])
+
+  for k, classind in enumerate(classinds):
+    gt_rows = gt_index.class_rows(classind)
+    gt_ignore = (gt_index.areas[gt_rows] < area_lo) | (gt_index.areas[gt_rows] > area_hi)
+    npig = np.sum(~gt_ignore, axis=1)
+    gt_offsets = np.searchsorted(gt_image_ids[gt_rows], image_range)
+
+    # the detections of an image cut at the largest max_dets
+    dets = order[class_offsets[k, 0]:class_offsets[k, 1]]
+    det_images = image_ids[dets]
+    ranks = np.arange(len(dets)) - np.searchsorted(det_images, det_images)
+    kept = ranks < max_dets[-1]
+    dets, det_images, ranks = dets[kept], det_images[kept], ranks[kept]
+    det_offsets = np.searchsorted(det_images, image_range)
+
+    cls_boxes = boxes[dets]
+    det_areas = (cls_boxes[:, 2] - cls_boxes[:, 0] + 1) * (cls_boxes[:, 3] - cls_boxes[:, 1] + 1)
+    dt_out_of_range = (det_areas < area_lo) | (det_areas > area_hi)
+    pair_det, pair_gt, pair_iou = candidate_pairs(cls_boxes, det_offsets, gt_index.boxes[gt_rows], gt_offsets,
+                                                  iou_thresholds[0])
+    cls_match, cls_ignore = match_detections(pair_det, pair_gt, pair_iou, ranks, gt_ignore, dt_out_of_range,
+                                             iou_thresholds)
+    cls_scores = scores[dets]
+
+    for m, max_det in enumerate(max_dets):
+      selected = np.nonzero(ranks < max_det)[0]
+      selected = selected[np.argsort(-cls_scores[selected], kind='mergesort')]
+      for a in range(nr_areas):
+        if npig[a] == 0:
+          continue
+        counted = ~cls_ignore[a][:, selected]
+        tp_sum = np.cumsum(cls_match[a][:, selected] & counted, axis=1, dtype=np.float64)
+        fp_sum = np.cumsum(~cls_match[a][:, selected] & counted, axis=1, dtype=np.float64)
+        rc = tp_sum / npig[a]
+        pr = tp_sum / np.maximum(tp_sum + fp_sum, np.spacing(1))
+        # precision envelope
+        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+        recall[:, k, a, m] = rc[:, -1] if len(selected) > 0 else 0
+        for t in range(nr_thresh):
+          inds = np.searchsorted(rc[t], COCO_RECALL_THRESHOLDS, side='left')
+          q = np.zeros(len(COCO_RECALL_THRESHOLDS))
+          valid = inds < len(selected)
+          q[valid] = pr[t, inds[valid]]
+          precision[t, :, k, a, m] = q
+
+  return precision, recall
+
+
+def summarize(precision, recall, classnames, max_dets=(1, 10, 100), iou_thresholds=COCO_IOU_THRESHOLDS,
+              area_ranges=COCO_AREA_RANGES):
+  """
+  The COCO summary metrics and per class APs from the output of coco_eval
+  returns:
+    dict with the thresholds, the summary "metrics" and the per class metrics "classes", -1 marks missing values
+  """
+  iou_thresholds = np.asarray(iou_thresholds)
+  t50 = np.nonzero(np.isclose(iou_thresholds, .5))[0]
+  t75 = np.nonzero(np.isclose(iou_thresholds, .75))[0]
+
+  def mean_valid(values):
+    values = values[values > -1]
+    return float(np.mean(values)) if len(values) > 0 else -1.
+
+  metrics = dict()
+  metrics["AP"] = mean_valid(precision[:, :, :, 0, -1])
+  metrics["AP50"] = mean_valid(precision[t50, :, :, 0, -1])
+  metrics["AP75"] = mean_valid(precision[t75, :, :, 0, -1])
+  for a, (name, _, _) in enumerate(area_ranges[1:], 1):
+    metrics["AP_" + name] = mean_valid(precision[:, :, :, a, -1])
+  for m, max_det in enumerate(max_dets):
+    metrics["AR@" + str(max_det)] = mean_valid(recall[:, :, 0, m])
+  for a, (name, _, _) in enumerate(area_ranges[1:], 1):
+    metrics["AR_" + name] = mean_valid(recall[:, :, a, -1])
+
+  classes = dict()
+  for k, classname in enumerate(classnames):
+    classes[classname] = {"AP": mean_valid(precision[:, :, k, 0, -1]),
+                          "AP50": mean_valid(precision[t50, :, k, 0, -1]),
+                          "AP75": mean_valid(precision[t75, :, k, 0, -1]),
+                          "AR": mean_valid(recall[:, k, 0, -1])}
+
+  return {"iou_thresholds": [float(t) for t in iou_thresholds],
+          "max_dets": [int(m) for m in max_dets],
+          "area_ranges": [[name, lo, hi] for name, lo, hi in area_ranges],
+          "metrics": metrics,
+          "classes": classes}
+
+
+def write_results(filename, summary):
+  """ Writes the output of summarize to a json file """
+  with open(filename, "w") as f:
+    json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def print_summary(summary):
+  for name, value in sorted(summary["metrics"].items()):
+    print('{:<10s} = {:.4f}'.format(name, value))
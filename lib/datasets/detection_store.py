@@ -0,0 +1,143 @@
+# --------------------------------------------------------
+# Columnar store for the detections of an imdb
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class DetectionStore(object):
+  """
+  Detections of an imdb in flat columns (image_id, class, score, x1, y1, x2, y2, pair) instead of the nested
+  all_boxes[pair][class][image] lists. Detections are appended image by image, the per class views are
+  computed from a sort index.
+  """
+  COLUMN_TYPES = [('image_id', np.int32), ('class', np.int32), ('score', np.float32),
+                  ('x1', np.float32), ('y1', np.float32), ('x2', np.float32), ('y2', np.float32),
+                  ('pair', np.int8)]
+
+  def __init__(self, num_images, num_classes, paired_data=1, capacity=4096):
+    self.num_images = num_images
+    self.num_classes = num_classes
+    self.paired_data = paired_data
+    self.size = 0
+    self.columns = dict((name, np.zeros(capacity, dtype=dtype)) for name, dtype in self.COLUMN_TYPES)
+    self.order = None
+    self.class_offsets = None
+
+  def __len__(self):
+    return self.size
+
+  def add(self, image_id, boxes, pair=0, scores=None):
+    """
+    Appends the detections of one image
+    inputs:
+      image_id - index of the image in the imdb
+      boxes - array of shape #dets x 5 with rows x1, y1, x2, y2, class
+      pair - which image of paired data the detections belong to
+      scores - detection scores, like in all_boxes the last column is used by default
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+    nr_dets = len(boxes)
+    if nr_dets == 0:
+      return
+
+    if self.size + nr_dets > len(self.columns['image_id']):
+      capacity = max(2 * len(self.columns['image_id']), self.size + nr_dets)
+      for name, column in self.columns.items():
+        self.columns[name] = np.resize(column, capacity)
+
+    rows = slice(self.size, self.size + nr_dets)
+    self.columns['image_id'][rows] = image_id
+    self.columns['class'][rows] = boxes[:, 4]
+    self.columns['score'][rows] = boxes[:, 4] if scores is None else scores
+    for col, name in enumerate(['x1', 'y1', 'x2', 'y2']):
+      self.columns[name][rows] = boxes[:, col]
+    self.columns['pair'][rows] = pair
+    self.size += nr_dets
+    self.order = None
+
+  def column(self, name):
+    return self.columns[name][:self.size]
+
+  def build_index(self):
+    """ Sorts the detections by pair, class and image, detections of an image keep the order they were added in """
+    self.order = np.lexsort((self.column('image_id'), self.column('class'), self.column('pair')))
+    keys = self.column('pair')[self.order].astype(np.int64) * self.num_classes + self.column('class')[self.order]
+    self.class_offsets = np.searchsorted(keys, np.arange(self.paired_data * self.num_classes + 1))
+
+  def class_view(self, classind, pair=0):
+    """ The detections of one class, see ClassDetections """
+    if self.order is None:
+      self.build_index()
+    key = pair * self.num_classes + classind
+    return ClassDetections(self, self.order[self.class_offsets[key]:self.class_offsets[key + 1]])
+
+  def all_boxes(self, pair=0):
+    """ all_boxes[pair] compatible list of the class views """
+    return [self.class_view(classind, pair) for classind in range(self.num_classes)]
+
+  def boxes_at(self, rows):
+    """ Array of shape #rows x 5 with columns x1, y1, x2, y2, score """
+    return np.stack([self.column(name)[rows] for name in ['x1', 'y1', 'x2', 'y2', 'score']], axis=1).astype(np.float64)
+
+  def subset(self, rows):
+    """ New store holding only the given rows, in that order """
+    store = DetectionStore(self.num_images, self.num_classes, self.paired_data, capacity=0)
+    store.columns = dict((name, self.column(name)[rows]) for name, _ in self.COLUMN_TYPES)
+    store.size = len(store.columns['image_id'])
+    return store
+
+  def save(self, filename):
+    """ Writes the columns to an uncompressed .npz file """
+    columns = dict((name, self.column(name)) for name, _ in self.COLUMN_TYPES)
+    np.savez(filename, num_images=self.num_images, num_classes=self.num_classes,
+             paired_data=self.paired_data, **columns)
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as data:
+      store = cls(int(data['num_images']), int(data['num_classes']), int(data['paired_data']), capacity=0)
+      store.columns = dict((name, data[name]) for name, _ in cls.COLUMN_TYPES)
+      store.size = len(store.columns['image_id'])
+    return store
+
+
+class ClassDetections(object):
+  """
+  View of the detections of one class that can be used like all_boxes[pair][class]: view[image] is [] or an
+  array of shape #dets x 5 (x1, y1, x2, y2, score).
+  """
+
+  def __init__(self, store, rows):
+    self.store = store
+    self.rows = rows
+    self.image_offsets = np.searchsorted(store.column('image_id')[rows], np.arange(store.num_images + 1))
+
+  def __len__(self):
+    return self.store.num_images
+
+  def __getitem__(self, image):
+    rows = self.rows[self.image_offsets[image]:self.image_offsets[image + 1]]
+    if len(rows) == 0:
+      return []
+    return self.store.boxes_at(rows)
+
+  def __iter__(self):
+    for image in range(len(self)):
+      yield self[image]
+
+  def __reduce__(self):
+    # a pickled view (e.g. sent to an evaluation process) carries only its own rows, not the whole store
+    return ClassDetections, (self.store.subset(self.rows), np.arange(len(self.rows)))
+
+  def stack(self):
+    """
+    image_ids, scores, boxes = stack()
+    All detections of the class at once, boxes has shape #dets x 4
+    """
+    boxes = self.store.boxes_at(self.rows)
+    return self.store.column('image_id')[self.rows].astype(np.int64), boxes[:, 4], boxes[:, :4]
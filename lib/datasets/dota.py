@@ -20,7 +20,7 @@ import utils.bbox
 import pickle
 import subprocess
 import uuid
-from datasets.voc_eval import voc_eval
+from datasets.voc_eval import voc_eval_table
 from datasets.voc_eval import parse_rec_dota
 #from main.config import cfg
 import random
@@ -51,6 +51,15 @@ class dota(imdb):
                    'use_salt': True,
                    'use_diff': False,
                    'matlab_eval': False,
+                   'export_results': False,
+                   'eval_workers': os.cpu_count() or 1,
+                   'ovthresh_list': [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95],
+                   # 'voc' for AP per threshold, 'coco' for the COCO metrics in one json file
+                   'eval_mode': 'voc',
+                   # our images hold far more than the 100 objects of a COCO image
+                   'coco_max_dets': [100, 1000, 10000],
+                   # value the inference pads images with, the black border of the aerial images
+                   'pad_value': 0,
                    'rpn_file': None}
 
     assert os.path.exists(self._devkit_path), \
@@ -118,25 +127,16 @@ class dota(imdb):
     """
     Return the database of ground-truth regions of interest.
 
-    This function loads/saves from/to a cache file to speed up future calls.
+    This function loads/saves from/to a cache file to speed up future calls,
+    only new or changed annotation files are parsed again.
     """
-    cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-    if os.path.exists(cache_file):
-      with open(cache_file, 'rb') as fid:
-        try:
-          roidb = pickle.load(fid)
-        except:
-          roidb = pickle.load(fid, encoding='bytes')
-      print('{} gt roidb loaded from {}'.format(self.name, cache_file))
-      return roidb
-
-    gt_roidb = [self._load_musical_annotation(index)
-                for index in self.image_index]
-    with open(cache_file, 'wb') as fid:
-      pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-    print('wrote gt roidb to {}'.format(cache_file))
-
-    return gt_roidb
+    return self.cached_gt_roidb('_load_musical_annotation')
+
+  def annotation_path(self, index):
+    """
+    Return the path of the annotation file of an image index.
+    """
+    return os.path.join(self._data_path, 'task1_5_tilted', index + '.txt')
 
   def rpn_roidb(self):
     if int(self._year) == 2018 or self._image_set != 'debug':
@@ -162,14 +162,13 @@ class dota(imdb):
     Load image and bounding boxes info from TXT file in the DOTAv1.5
     format.
     """
-    filename = os.path.join(self._data_path, 'task1_5_tilted', index + '.txt')
+    filename = self.annotation_path(index)
     objs = parse_rec_dota(filename)
     num_objs = len(objs)
 
     boxes = np.zeros((num_objs, 4), dtype=np.uint16)
     boxes_full = np.zeros((num_objs, 8), dtype=np.uint16)
     gt_classes = np.zeros((num_objs), dtype=np.int32)
-    overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
     # "Seg" area for pascal is just the box area
     seg_areas = np.zeros((num_objs), dtype=np.float32)
 
@@ -181,16 +180,12 @@ class dota(imdb):
       cls = self._class_to_ind[objs[ix]['name'].lower().strip()]
       boxes[ix, :] = [x1, y1, x2, y2]
       gt_classes[ix] = cls
-      overlaps[ix, cls] = 1.0
       seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
       boxes_full[ix, :] = obj['bbox_full']
 
-    overlaps = scipy.sparse.csr_matrix(overlaps)
-
     return {'boxes': boxes,
             'boxes_full': boxes_full,
             'gt_classes': gt_classes,
-            'gt_overlaps': overlaps,
             'flipped': False,
             'seg_areas': seg_areas}
 
@@ -228,33 +223,34 @@ class dota(imdb):
                            dets[k, 0] + 1, dets[k, 1] + 1,
                            dets[k, 2] + 1, dets[k, 3] + 1))
 
-  def _do_python_eval(self, output_dir='output', path=None):
-    annopath = os.path.join(
-      self._devkit_path,
-      'segmentation_detection',
-      'xml_annotations',
-      '{:s}.txt')
-    imagesetfile = os.path.join(
-      self._devkit_path,
-      'train_val_test',
-      self._image_set + '.txt')
-    cachedir = os.path.join(self._devkit_path, 'annotations_cache')
+  def _do_python_eval(self, output_dir='output', path=None, pair=0, all_boxes=None, evaluator=None):
     # The PASCAL VOC metric changed in 2010
     use_07_metric = True if int(self._year) < 2010 else False
     print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
     if not os.path.isdir(output_dir):
       os.mkdir(output_dir)
 
-    ovthresh_list = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
-    for ovthresh in ovthresh_list:
+    ovthresh_list = self.config['ovthresh_list']
+    classes = self._eval_classes()
+    if evaluator is not None:
+      # matched image by image while the inference ran
+      ap_table, rec_table, prec_table = evaluator.evaluate()
+    else:
+      # evaluate in memory, fall back to the exported results files
+      if all_boxes is not None:
+        detections = [all_boxes[i] for i, _ in classes]
+        ground_truth = self.gt_index(pair)
+      else:
+        detections = [self._get_voc_results_file_template() for _ in classes]
+        ground_truth = self.roidb
+      # every class is matched once for all thresholds
+      ap_table, rec_table, prec_table = voc_eval_table(
+        detections, ground_truth, pair, [cls for _, cls in classes], [i for i, _ in classes],
+        ovthresh_list, use_07_metric=use_07_metric, num_workers=self.config['eval_workers'])
+    for t, ovthresh in enumerate(ovthresh_list):
       aps = []
-      for i, cls in enumerate(self._classes):
-        if cls == '__background__':
-          continue
-        filename = self._get_voc_results_file_template().format(cls)
-        rec, prec, ap = voc_eval(
-          filename, annopath, imagesetfile, cls, cachedir, ovthresh=ovthresh,
-          use_07_metric=use_07_metric)
+      for c, (i, cls) in enumerate(classes):
+        rec, prec, ap = rec_table[t][c], prec_table[t][c], ap_table[t, c]
         aps += [ap]
         print(('AP for {} = {:.4f}'.format(cls, ap)))
         with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
@@ -305,12 +301,21 @@ class dota(imdb):
     print(('Running:\n{}'.format(cmd)))
     status = subprocess.call(cmd, shell=True)
 
-  def evaluate_detections(self, all_boxes, output_dir, path=None):
-    self._write_voc_results_file(all_boxes)
-    self._do_python_eval(output_dir, path)
+  def evaluate_streaming(self, evaluator, output_dir, path=None, pair=0):
+    self.evaluate_detections(None, output_dir, path, pair, evaluator)
+
+  def evaluate_detections(self, all_boxes, output_dir, path=None, pair=0, evaluator=None):
+    # the results files are only needed for the matlab code or when explicitly exported
+    export = self.config['export_results'] or self.config['matlab_eval']
+    if export and all_boxes is not None:
+      self._write_voc_results_file(all_boxes)
+    if self.config['eval_mode'] == 'coco' and evaluator is None:
+      self._do_coco_eval(all_boxes, output_dir, pair)
+    else:
+      self._do_python_eval(output_dir, path, pair, all_boxes, evaluator)
     if self.config['matlab_eval']:
       self._do_matlab_eval(output_dir)
-    if self.config['cleanup']:
+    if export and all_boxes is not None and self.config['cleanup']:
       for cls in self._classes:
         if cls == '__background__':
           continue
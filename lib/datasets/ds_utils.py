@@ -8,6 +8,7 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
+import scipy.sparse
 
 
 def unique_boxes(boxes, scale=1.0):
@@ -47,3 +48,54 @@ def filter_small_boxes(boxes, min_size):
   h = boxes[:, 3] - boxes[:, 1]
   keep = np.where((w >= min_size) & (h > min_size))[0]
   return keep
+
+
+def greedy_max_overlaps(overlaps):
+  """
+  One to one greedy assignment of proposals (rows) to gt boxes (columns) as
+  in evaluate_recall: the pair with the largest overlap is assigned first
+  (ties go to the lower gt index, then the lower proposal index), then the
+  largest pair of two unassigned boxes and so on. All pairs that are the best
+  remaining pair of their proposal and of their gt box are assigned at once,
+  which gives the same assignment as assigning them one by one.
+  Returns the overlap of every gt box with its proposal, 0 if unassigned.
+  """
+  gt_overlaps = np.zeros(overlaps.shape[1])
+  rows, cols = np.nonzero(overlaps > 0)
+  values = overlaps[rows, cols]
+  order = np.lexsort((rows, cols, -values))
+  rows, cols, values = rows[order], cols[order], values[order]
+  while len(rows) > 0:
+    # pairs are sorted best first, the first pair of a row (column) is its best one
+    _, row_first = np.unique(rows, return_index=True)
+    _, col_first = np.unique(cols, return_index=True)
+    assigned = np.intersect1d(row_first, col_first, assume_unique=True)
+    gt_overlaps[cols[assigned]] = values[assigned]
+    keep = ~np.isin(rows, rows[assigned]) & ~np.isin(cols, cols[assigned])
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+  return gt_overlaps
+
+
+def max_overlap_fields(roidb_entry):
+  """
+  max_classes, max_overlaps of the objects of a roidb entry. Ground truth
+  only entries without gt_overlaps are one-hot at their gt_classes, else the
+  maxima over the classes are taken from the sparse gt_overlaps directly.
+  """
+  if 'gt_overlaps' not in roidb_entry:
+    max_classes = np.asarray(roidb_entry['gt_classes'], dtype=np.int64)
+    return max_classes, np.ones(len(max_classes), dtype=np.float32)
+  overlaps = roidb_entry['gt_overlaps'].tocsr()
+  if overlaps.shape[0] == 0 or overlaps.shape[1] == 0:
+    return np.zeros(overlaps.shape[0], dtype=np.int64), np.zeros(overlaps.shape[0], dtype=np.float32)
+  max_overlaps = overlaps.max(axis=1).toarray().ravel()
+  max_classes = np.asarray(overlaps.argmax(axis=1)).ravel().astype(np.int64)
+  return max_classes, max_overlaps
+
+
+def one_hot_overlaps(gt_classes, num_classes):
+  """ Sparse gt_overlaps of ground truth objects, 1 at their class """
+  gt_classes = np.asarray(gt_classes)
+  return scipy.sparse.csr_matrix((np.ones(len(gt_classes), dtype=np.float32),
+                                  (np.arange(len(gt_classes)), gt_classes)),
+                                 shape=(len(gt_classes), num_classes))
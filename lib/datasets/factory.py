@@ -12,16 +12,28 @@ from __future__ import print_function
 
 import sys
 sys.path.insert(0, '/DeepWatershedDetection/lib')
+import importlib
 
 __sets = {}
-from datasets.pascal_voc import pascal_voc
-from datasets.coco import coco
-from datasets.deep_scores import deep_scores
-from datasets.deep_scores_300dpi import deep_scores_300dpi
-from datasets.deep_scores_ipad import deep_scores_ipad
-from datasets.musicma import musicma
-from datasets.dota import dota
-from datasets.macrophages import macrophages
+# constructed imdbs, keyed by name and args
+__imdbs = {}
+
+
+def lazy_dataset(module_name, class_name):
+  """Constructor of a dataset class that imports its module on the first call."""
+  def construct(args, split, year):
+    return getattr(importlib.import_module(module_name), class_name)(args, split, year)
+  return construct
+
+
+pascal_voc = lazy_dataset('datasets.pascal_voc', 'pascal_voc')
+coco = lazy_dataset('datasets.coco', 'coco')
+deep_scores = lazy_dataset('datasets.deep_scores', 'deep_scores')
+deep_scores_300dpi = lazy_dataset('datasets.deep_scores_300dpi', 'deep_scores_300dpi')
+deep_scores_ipad = lazy_dataset('datasets.deep_scores_ipad', 'deep_scores_ipad')
+musicma = lazy_dataset('datasets.musicma', 'musicma')
+dota = lazy_dataset('datasets.dota', 'dota')
+macrophages = lazy_dataset('datasets.macrophages', 'macrophages')
 
 # Set up voc_<year>_<split> 
 for year in ['2007', '2012']:
@@ -84,13 +96,22 @@ for year in ['2019']:
     name = 'macrophages_{}_{}'.format(year, split)
     __sets[name] = (lambda args, split=split, year=year: macrophages(args, split, year))
 
-def get_imdb(args,name):
-  """Get an imdb (image database) by name."""
-  print(name)
+def get_imdb(args, name, cached=True):
+  """Get an imdb (image database) by name.
+
+  Each imdb is constructed once per process and args object, later calls
+  return the same instance. cached=False constructs a new one.
+  """
   if name not in __sets:
     raise KeyError('Unknown dataset: {}'.format(name))
-  print(__sets[name](args))
-  return __sets[name](args)
+  if not cached:
+    return __sets[name](args)
+  key = (name, id(args))
+  if key not in __imdbs:
+    print(name)
+    # args is kept with the imdb so that its id is not reused
+    __imdbs[key] = (args, __sets[name](args))
+  return __imdbs[key][1]
 
 
 def list_imdbs():
@@ -0,0 +1,149 @@
+# --------------------------------------------------------
+# Flat ground truth index for the evaluation
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+
+
+def read_fingerprint(cache_dir):
+  """ Fingerprint of the source a cache directory was built from, None if it has none """
+  filename = os.path.join(cache_dir, 'fingerprint.txt')
+  if not os.path.exists(filename):
+    return None
+  with open(filename) as fid:
+    return fid.read().strip()
+
+
+def write_fingerprint(cache_dir, fingerprint):
+  with open(os.path.join(cache_dir, 'fingerprint.txt'), 'w') as fid:
+    fid.write(fingerprint)
+
+
+class GTIndex(object):
+  """
+  Ground truth of an imdb in flat arrays. The objects of all images are
+  stored contiguously, the objects of image i are the rows
+  image_offsets[i]:image_offsets[i + 1] of boxes, classes and areas.
+  The rows of the objects of class k (in image order) are
+  class_order[class_offsets[k]:class_offsets[k + 1]].
+  """
+  ARRAYS = ['boxes', 'classes', 'areas', 'class_order', 'class_offsets', 'image_offsets']
+
+  def __init__(self, boxes, classes, areas, image_offsets, class_order=None, class_offsets=None):
+    self.boxes = boxes
+    self.classes = classes
+    self.areas = areas
+    self.image_offsets = image_offsets
+    if class_order is None:
+      class_order = np.argsort(classes, kind='mergesort')
+      max_class = classes.max() if len(classes) > 0 else 0
+      class_offsets = np.searchsorted(classes[class_order], np.arange(max_class + 2))
+    self.class_order = class_order
+    self.class_offsets = class_offsets
+
+  @classmethod
+  def from_roidb(cls, roidb, pair=0):
+    """
+    Builds the index from the roidb of an imdb
+    inputs:
+      roidb - list of roidb entries, paired datasets hold a list of entries per image
+      pair - which entry of paired roidb entries to use
+    returns:
+      the GTIndex, the areas are the seg_areas of the roidb if present, the box areas otherwise
+    """
+    boxes, classes, areas, counts = [], [], [], []
+    for roidb_entry in roidb:
+      if isinstance(roidb_entry, list):
+        roidb_entry = roidb_entry[pair]
+      entry_boxes = np.asarray(roidb_entry["boxes"], dtype=np.float64).reshape(-1, 4)
+      boxes.append(entry_boxes)
+      classes.append(np.asarray(roidb_entry["gt_classes"], dtype=np.int32))
+      if "seg_areas" in roidb_entry:
+        areas.append(np.asarray(roidb_entry["seg_areas"], dtype=np.float64))
+      else:
+        areas.append((entry_boxes[:, 2] - entry_boxes[:, 0] + 1) * (entry_boxes[:, 3] - entry_boxes[:, 1] + 1))
+      counts.append(len(entry_boxes))
+
+    image_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return cls(np.concatenate([np.zeros((0, 4))] + boxes),
+               np.concatenate([np.zeros(0, dtype=np.int32)] + classes),
+               np.concatenate([np.zeros(0)] + areas),
+               image_offsets)
+
+  @property
+  def num_images(self):
+    return len(self.image_offsets) - 1
+
+  def image_ids(self):
+    """ Image index of every object """
+    return np.repeat(np.arange(self.num_images), np.diff(self.image_offsets))
+
+  def image_slice(self, i):
+    """ Rows of the objects of image i """
+    return slice(self.image_offsets[i], self.image_offsets[i + 1])
+
+  def class_rows(self, classind):
+    """ Rows of the objects of a class, in image order """
+    if classind + 1 >= len(self.class_offsets):
+      return np.zeros(0, dtype=np.int64)
+    return self.class_order[self.class_offsets[classind]:self.class_offsets[classind + 1]]
+
+  def class_ground_truth(self, classind):
+    """
+    gt_boxes, gt_difficult, npos = class_ground_truth(classind)
+    Per image ground truth boxes and difficult flags of one class, as datasets.voc_eval.class_ground_truth
+    """
+    rows = self.class_rows(classind)
+    images = np.searchsorted(self.image_offsets, rows, side='right') - 1
+    counts = np.bincount(images, minlength=self.num_images)
+    gt_boxes = np.split(np.asarray(self.boxes[rows], dtype=np.float64), np.cumsum(counts)[:-1])
+    gt_difficult = [np.zeros(count, dtype=bool) for count in counts]
+    return gt_boxes, gt_difficult, len(rows)
+
+  def save(self, cache_dir):
+    """ Writes every array to a .npy file in cache_dir, image_offsets.npy is written last and marks a complete index """
+    marker = os.path.join(cache_dir, 'image_offsets.npy')
+    if os.path.exists(marker):
+      os.remove(marker)
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    for name in self.ARRAYS:
+      np.save(os.path.join(cache_dir, name + '.npy'), getattr(self, name))
+
+  @classmethod
+  def load(cls, cache_dir):
+    """ Opens an index written by save, the arrays are memory mapped """
+    arrays = dict((name, np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')) for name in cls.ARRAYS)
+    return cls(**arrays)
+
+  @classmethod
+  def cached(cls, cache_dir, roidb_fn, pair=0, source=None, num_images=None, fingerprint=None):
+    """
+    Loads the index from cache_dir or builds it from the roidb and stores it there
+    inputs:
+      cache_dir - directory of the index files
+      roidb_fn - function returning the roidb, only called if the index has to be built
+      pair - which entry of paired roidb entries to use
+      source - file the roidb is cached in, the index is rebuilt if it is newer
+      num_images - the index is rebuilt if it has a different number of images
+      fingerprint - string identifying the annotations, the index is rebuilt if it was built from other ones
+    """
+    marker = os.path.join(cache_dir, 'image_offsets.npy')
+    if os.path.exists(marker):
+      stale = source is not None and os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(marker)
+      stale = stale or (fingerprint is not None and read_fingerprint(cache_dir) != fingerprint)
+      if not stale:
+        index = cls.load(cache_dir)
+        if num_images is None or index.num_images == num_images:
+          return index
+
+    print('building ground truth index {}'.format(cache_dir))
+    cls.from_roidb(roidb_fn(), pair).save(cache_dir)
+    if fingerprint is not None:
+      write_fingerprint(cache_dir, fingerprint)
+    return cls.load(cache_dir)
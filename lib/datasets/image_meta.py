@@ -0,0 +1,114 @@
+# --------------------------------------------------------
+# Persistent image metadata index
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import PIL.Image
+
+
+def probe_image(path):
+  """ (width, height, mode) of an image, PIL only reads the header """
+  with PIL.Image.open(path) as im:
+    return im.size[0], im.size[1], im.mode
+
+
+def image_mtime(path):
+  return os.stat(path).st_mtime_ns
+
+
+def map_io(fn, items, num_workers):
+  """ map over file system calls with a thread pool, they release the GIL while they wait for the storage """
+  if num_workers <= 1 or len(items) <= 1:
+    return [fn(item) for item in items]
+  with ThreadPoolExecutor(max_workers=num_workers) as pool:
+    return list(pool.map(fn, items, chunksize=64))
+
+
+class ImageMetaIndex(object):
+  """
+  Width, height, mode and mtime of a set of images, keyed by path. It is kept in an .npz file so that the images
+  do not have to be opened on every start, only new images and images whose mtime changed are probed again.
+  """
+  COLUMNS = ['paths', 'widths', 'heights', 'modes', 'mtimes']
+
+  def __init__(self, paths, widths, heights, modes, mtimes):
+    self.paths = np.asarray(paths, dtype=str)
+    self.widths = np.asarray(widths, dtype=np.int64)
+    self.heights = np.asarray(heights, dtype=np.int64)
+    self.modes = np.asarray(modes, dtype=str)
+    self.mtimes = np.asarray(mtimes, dtype=np.int64)
+    self.rows = dict((path, row) for row, path in enumerate(self.paths.tolist()))
+
+  def __len__(self):
+    return len(self.paths)
+
+  def __contains__(self, path):
+    return path in self.rows
+
+  def lookup(self, paths):
+    """ Rows of the given paths """
+    return np.array([self.rows[path] for path in paths], dtype=np.int64)
+
+  def sizes(self, paths):
+    """ List of (width, height) of the given paths, like PIL.Image.size """
+    rows = self.lookup(paths)
+    return list(zip(self.widths[rows].tolist(), self.heights[rows].tolist()))
+
+  @classmethod
+  def build(cls, paths, num_workers=None, previous=None):
+    """
+    Index of the unique images in paths
+    inputs:
+      paths - image paths, duplicates are indexed once
+      num_workers - threads for the stat and header reads, defaults to the number of cpus
+      previous - an older index, its entries are reused for images with an unchanged mtime
+    returns:
+      the ImageMetaIndex and the number of images that were probed
+    """
+    if num_workers is None:
+      num_workers = os.cpu_count() or 1
+    paths = list(dict.fromkeys(paths))
+    mtimes = map_io(image_mtime, paths, num_workers)
+
+    metas = [None] * len(paths)
+    if previous is not None:
+      for ix, (path, mtime) in enumerate(zip(paths, mtimes)):
+        row = previous.rows.get(path)
+        if row is not None and previous.mtimes[row] == mtime:
+          metas[ix] = (previous.widths[row], previous.heights[row], previous.modes[row])
+    stale = [ix for ix, meta in enumerate(metas) if meta is None]
+    for ix, meta in zip(stale, map_io(probe_image, [paths[ix] for ix in stale], num_workers)):
+      metas[ix] = meta
+
+    widths, heights, modes = zip(*metas) if len(metas) > 0 else ((), (), ())
+    return cls(paths, widths, heights, modes, mtimes), len(stale)
+
+  def save(self, filename):
+    np.savez(filename, **dict((name, getattr(self, name)) for name in self.COLUMNS))
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as data:
+      return cls(**dict((name, data[name]) for name in cls.COLUMNS))
+
+  @classmethod
+  def cached(cls, filename, paths, num_workers=None):
+    """
+    Loads the index from filename, probes the images that are new or changed and writes it back if anything changed
+    inputs:
+      filename - .npz file of the index
+      paths - the images the index has to cover
+      num_workers - see build
+    """
+    previous = cls.load(filename) if os.path.exists(filename) else None
+    index, nr_probed = cls.build(paths, num_workers, previous)
+    if previous is None or nr_probed > 0 or len(index) != len(previous):
+      print('probed {} of {} images, writing image metadata index {}'.format(nr_probed, len(index), filename))
+      index.save(filename)
+    return index
@@ -12,12 +12,38 @@ import sys
 sys.path.insert(0, '/cluster/home/elez/DeepWatershedDetection/lib')
 import os
 import os.path as osp
-import PIL
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from utils.bbox import bbox_overlaps
+from datasets.gt_index import GTIndex
+from datasets.ds_utils import greedy_max_overlaps, max_overlap_fields, one_hot_overlaps
+from datasets.image_meta import ImageMetaIndex, image_mtime, map_io
+from datasets.coco_style_eval import flatten_detections, coco_eval, summarize, write_results, print_summary
+from datasets.voc_eval import StreamingEvaluator
 import numpy as np
 import scipy.sparse
 #from main.config import cfg
 
+# imdb of the roidb worker processes, set once per worker by init_roidb_worker
+worker_imdb = None
+
+
+def init_roidb_worker(imdb_obj):
+  global worker_imdb
+  worker_imdb = imdb_obj
+
+
+def roidb_worker(load_annotation, index):
+  return getattr(worker_imdb, load_annotation)(index)
+
+
+def annotation_digest(paths, mtimes):
+  digest = hashlib.sha1()
+  for path, mtime in zip(paths, mtimes):
+    digest.update('{} {}\n'.format(path, mtime).encode('utf-8'))
+  return digest.hexdigest()
+
 
 class imdb(object):
   """Image database."""
@@ -33,6 +59,8 @@ class imdb(object):
     self._obj_proposer = 'gt'
     self._roidb = None
     self._roidb_handler = self.default_roidb
+    self._image_meta = None
+    self._annotation_fingerprint = None
     self.args = args
     # Use this dict for storing dataset specific config options
     self.config = {}
@@ -70,7 +98,7 @@ class imdb(object):
   def roidb(self):
     # A roidb is a list of dictionaries, each with the following keys:
     #   boxes
-    #   gt_overlaps
+    #   gt_overlaps (only if not one-hot at gt_classes)
     #   gt_classes
     #   flipped
     if self._roidb is not None:
@@ -89,6 +117,95 @@ class imdb(object):
   def num_images(self):
     return len(self.image_index)
 
+  def gt_index(self, pair=0):
+    """
+    Flat ground truth index of the roidb for the evaluation. It is built once per split and kept as memory mapped
+    arrays in the cache directory, it is rebuilt when an annotation changes or the gt_roidb cache is newer.
+    """
+    cache_dir = osp.join(self.cache_path, self.name + '_gt_index_' + str(pair))
+    roidb_cache = osp.join(self.cache_path, self.name + '_gt_roidb.pkl')
+    return GTIndex.cached(cache_dir, lambda: self.roidb, pair, source=roidb_cache, num_images=self.num_images,
+                          fingerprint=self.annotation_fingerprint())
+
+  def image_sizes(self):
+    """
+    (width, height) of every image, read from the image metadata index next to the gt_roidb cache. Only images
+    that are new or changed since the index was written are opened.
+    """
+    paths = [self.image_path_at(i) for i in range(self.num_images)]
+    if self._image_meta is None or not all(path in self._image_meta for path in paths):
+      self._image_meta = ImageMetaIndex.cached(osp.join(self.cache_path, self.name + '_image_meta.npz'), paths)
+    return self._image_meta.sizes(paths)
+
+  def annotation_path(self, index):
+    """ File or directory the annotation of an image is read from, its mtime keys the gt roidb cache """
+    raise NotImplementedError
+
+  def annotation_mtimes(self):
+    """ Annotation path and mtime of every image, in image order """
+    num_workers = self.config.get('roidb_workers', os.cpu_count() or 1)
+    paths = [self.annotation_path(index) for index in self.image_index]
+    return paths, map_io(image_mtime, paths, num_workers)
+
+  def annotation_fingerprint(self):
+    """
+    Hash of the annotation paths and mtimes of the split, it changes when an annotation is edited, added or removed.
+    The annotations are stat-ed once per instance, by cached_gt_roidb or the first call. None if the imdb has no
+    annotation_path.
+    """
+    if self._annotation_fingerprint is None:
+      try:
+        paths, mtimes = self.annotation_mtimes()
+      except NotImplementedError:
+        return None
+      self._annotation_fingerprint = annotation_digest(paths, mtimes)
+    return self._annotation_fingerprint
+
+  def cached_gt_roidb(self, load_annotation):
+    """
+    gt roidb of all images. The entries are cached in <name>_gt_roidb.pkl per annotation path together with the
+    mtime of the annotation, only new or changed annotations are parsed again, spread over a process pool.
+    inputs:
+      load_annotation - name of the method that parses the annotation of an image index
+    """
+    cache_file = osp.join(self.cache_path, self.name + '_gt_roidb.pkl')
+    cache = {}
+    if osp.exists(cache_file):
+      with open(cache_file, 'rb') as fid:
+        try:
+          cache = pickle.load(fid)
+        except:
+          fid.seek(0)
+          cache = pickle.load(fid, encoding='bytes')
+      # caches of a single list of entries are rebuilt
+      if not isinstance(cache, dict):
+        cache = {}
+
+    num_workers = self.config.get('roidb_workers', os.cpu_count() or 1)
+    paths, mtimes = self.annotation_mtimes()
+    self._annotation_fingerprint = annotation_digest(paths, mtimes)
+    stale = [ix for ix, (path, mtime) in enumerate(zip(paths, mtimes))
+             if path not in cache or cache[path][0] != mtime]
+    if len(stale) == 0 and len(cache) == len(set(paths)):
+      print('{} gt roidb loaded from {}'.format(self.name, cache_file))
+      return [cache[path][1] for path in paths]
+
+    indices = [self.image_index[ix] for ix in stale]
+    if num_workers <= 1 or len(indices) < 2 * num_workers:
+      entries = [getattr(self, load_annotation)(index) for index in indices]
+    else:
+      chunksize = max(1, len(indices) // (4 * num_workers))
+      with ProcessPoolExecutor(max_workers=num_workers, initializer=init_roidb_worker, initargs=(self,)) as pool:
+        entries = list(pool.map(roidb_worker, [load_annotation] * len(indices), indices, chunksize=chunksize))
+
+    for ix, entry in zip(stale, entries):
+      cache[paths[ix]] = (mtimes[ix], entry)
+    cache = dict((path, cache[path]) for path in paths)
+    with open(cache_file, 'wb') as fid:
+      pickle.dump(cache, fid, pickle.HIGHEST_PROTOCOL)
+    print('parsed {} of {} annotations, wrote gt roidb to {}'.format(len(stale), len(paths), cache_file))
+    return [cache[path][1] for path in paths]
+
   def semseg_index(self):
     raise NotImplementedError
 
@@ -109,9 +226,59 @@ class imdb(object):
     """
     raise NotImplementedError
 
+  def _eval_classes(self):
+    """ (index, name) of the classes the VOC evaluation reports """
+    return [(i, cls) for i, cls in enumerate(self._classes) if cls != '__background__']
+
+  def streaming_evaluator(self, pair=0):
+    """ StreamingEvaluator that test_net can feed image by image, evaluated like _do_python_eval """
+    classes = self._eval_classes()
+    # The PASCAL VOC metric changed in 2010
+    use_07_metric = int(getattr(self, '_year', 2010)) < 2010
+    ovthresh_list = self.config.get('ovthresh_list', [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+    return StreamingEvaluator(self.gt_index(pair), [cls for _, cls in classes],
+                              [i for i, _ in classes], ovthresh_list, use_07_metric)
+
+  def evaluate_streaming(self, evaluator, output_dir, path=None, pair=0):
+    """
+    Reports a streaming_evaluator that test_net fed image by image: the AP of every class and the mean AP per
+    overlap threshold, the precision recall curves are written to output_dir/<class>_pr.pkl. Datasets whose
+    evaluate_detections takes the evaluator report it like their other evaluations.
+    """
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    ap_table, rec_table, prec_table = evaluator.evaluate()
+    for t, ovthresh in enumerate(evaluator.ovthresh_list):
+      print('Overlap threshold {}'.format(ovthresh))
+      for c, cls in enumerate(evaluator.classnames):
+        print('AP for {} = {:.4f}'.format(cls, ap_table[t, c]))
+        with open(os.path.join(output_dir, cls + '_pr.pkl'), 'wb') as f:
+          pickle.dump({'rec': rec_table[t][c], 'prec': prec_table[t][c], 'ap': ap_table[t, c]}, f)
+      print('Mean AP = {:.4f}'.format(np.nanmean(ap_table[t]) if len(evaluator.classnames) > 0 else 0.))
+
+  def _do_coco_eval(self, all_boxes, output_dir='output', pair=0):
+    """
+    COCO-style evaluation of all_boxes against the ground truth of the given pair, the summary is printed and
+    written to output_dir/coco_eval.json. config['coco_max_dets'] sets the detection limits, default (1, 10, 100).
+    """
+    if not os.path.isdir(output_dir):
+      os.mkdir(output_dir)
+
+    classes = [(i, cls) for i, cls in enumerate(self._classes) if cls != '__background__']
+    classinds = [i for i, _ in classes]
+    gt_index = self.gt_index(pair)
+    image_ids, class_ids, scores, boxes = flatten_detections(all_boxes, classinds)
+    max_dets = self.config.get('coco_max_dets', (1, 10, 100))
+    precision, recall = coco_eval(gt_index, image_ids, class_ids, scores, boxes, classinds, max_dets=max_dets)
+    summary = summarize(precision, recall, [cls for _, cls in classes], max_dets=max_dets)
+    write_results(os.path.join(output_dir, 'coco_eval.json'), summary)
+    print('~~~~~~~~')
+    print('COCO-style results:')
+    print_summary(summary)
+    print('~~~~~~~~')
+
   def _get_widths(self):
-    return [PIL.Image.open(self.image_path_at(i)).size[0]
-            for i in range(self.num_images)]
+    return [width for width, _ in self.image_sizes()]
 
   def append_flipped_images(self):
     num_images = self.num_images
@@ -124,9 +291,10 @@ class imdb(object):
       boxes[:, 2] = widths[i] - oldx1 - 1
       #assert (boxes[:, 2] >= boxes[:, 0]).all()  - why this is throwing error when uncommented?!
       entry = {'boxes': boxes,
-               'gt_overlaps': self.roidb[i]['gt_overlaps'],
                'gt_classes': self.roidb[i]['gt_classes'],
                'flipped': True}
+      if 'gt_overlaps' in self.roidb[i]:
+        entry['gt_overlaps'] = self.roidb[i]['gt_overlaps']
       self.roidb.append(entry)
     self._image_index = self._image_index * 2
 
@@ -134,12 +302,16 @@ class imdb(object):
                       area='all', limit=None):
     """Evaluate detection proposal recall metrics.
 
+    area is the name of an area range or a list of names, the overlaps of
+    every image are computed once and shared by all requested area ranges.
+
     Returns:
         results: dictionary of results with keys
             'ar': average recall
             'recalls': vector recalls at each IoU overlap threshold
             'thresholds': vector of IoU overlap thresholds
             'gt_overlaps': vector of all ground-truth overlaps
+        for a list of area ranges a dictionary with these results per area
     """
     # Record max overlap value for each gt box
     # Return vector of overlap values
@@ -154,22 +326,24 @@ class imdb(object):
                    [256 ** 2, 512 ** 2],  # 256-512
                    [512 ** 2, 1e5 ** 2],  # 512-inf
                    ]
-    assert area in areas, 'unknown area range: {}'.format(area)
-    area_range = area_ranges[areas[area]]
-    gt_overlaps = np.zeros(0)
-    num_pos = 0
+    area_names = [area] if isinstance(area, str) else list(area)
+    for name in area_names:
+      assert name in areas, 'unknown area range: {}'.format(name)
+    area_lo = np.array([area_ranges[areas[name]][0] for name in area_names])[:, None]
+    area_hi = np.array([area_ranges[areas[name]][1] for name in area_names])[:, None]
+    gt_overlaps = [[] for _ in area_names]
+    num_pos = np.zeros(len(area_names), dtype=np.int64)
     for i in range(self.num_images):
       # Checking for max_overlaps == 1 avoids including crowd annotations
       # (...pretty hacking :/)
-      max_gt_overlaps = self.roidb[i]['gt_overlaps'].toarray().max(axis=1)
+      _, max_gt_overlaps = max_overlap_fields(self.roidb[i])
       gt_inds = np.where((self.roidb[i]['gt_classes'] > 0) &
                          (max_gt_overlaps == 1))[0]
       gt_boxes = self.roidb[i]['boxes'][gt_inds, :]
       gt_areas = self.roidb[i]['seg_areas'][gt_inds]
-      valid_gt_inds = np.where((gt_areas >= area_range[0]) &
-                               (gt_areas <= area_range[1]))[0]
-      gt_boxes = gt_boxes[valid_gt_inds, :]
-      num_pos += len(valid_gt_inds)
+      # area ranges x gt boxes
+      valid_gt = (gt_areas >= area_lo) & (gt_areas <= area_hi)
+      num_pos += valid_gt.sum(axis=1)
 
       if candidate_boxes is None:
         # If candidate_boxes is not supplied, the default is to use the
@@ -183,42 +357,27 @@ class imdb(object):
       if limit is not None and boxes.shape[0] > limit:
         boxes = boxes[:limit, :]
 
-      overlaps = bbox_overlaps(boxes.astype(np.float),
-                               gt_boxes.astype(np.float))
-
-      _gt_overlaps = np.zeros((gt_boxes.shape[0]))
-      for j in range(gt_boxes.shape[0]):
-        # find which proposal box maximally covers each gt box
-        argmax_overlaps = overlaps.argmax(axis=0)
-        # and get the iou amount of coverage for each gt box
-        max_overlaps = overlaps.max(axis=0)
-        # find which gt box is 'best' covered (i.e. 'best' = most iou)
-        gt_ind = max_overlaps.argmax()
-        gt_ovr = max_overlaps.max()
-        assert (gt_ovr >= 0)
-        # find the proposal box that covers the best covered gt box
-        box_ind = argmax_overlaps[gt_ind]
-        # record the iou coverage of this gt box
-        _gt_overlaps[j] = overlaps[box_ind, gt_ind]
-        assert (_gt_overlaps[j] == gt_ovr)
-        # mark the proposal box and the gt box as used
-        overlaps[box_ind, :] = -1
-        overlaps[:, gt_ind] = -1
-      # append recorded iou coverage level
-      gt_overlaps = np.hstack((gt_overlaps, _gt_overlaps))
-
-    gt_overlaps = np.sort(gt_overlaps)
+      overlaps = bbox_overlaps(boxes, gt_boxes)
+      # the gt boxes of each area range are assigned to the proposals separately
+      for a in range(len(area_names)):
+        gt_overlaps[a].append(greedy_max_overlaps(overlaps[:, valid_gt[a]]))
+
     if thresholds is None:
       step = 0.05
       thresholds = np.arange(0.5, 0.95 + 1e-5, step)
-    recalls = np.zeros_like(thresholds)
-    # compute recall for each iou threshold
-    for i, t in enumerate(thresholds):
-      recalls[i] = (gt_overlaps >= t).sum() / float(num_pos)
-    # ar = 2 * np.trapz(recalls, thresholds)
-    ar = recalls.mean()
-    return {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
-            'gt_overlaps': gt_overlaps}
+    thresholds = np.asarray(thresholds)
+    results = {}
+    for a, name in enumerate(area_names):
+      area_overlaps = np.sort(np.concatenate([np.zeros(0)] + gt_overlaps[a]))
+      # compute recall for each iou threshold
+      recalls = (len(area_overlaps) - np.searchsorted(area_overlaps, thresholds, side='left')) / float(num_pos[a])
+      # ar = 2 * np.trapz(recalls, thresholds)
+      ar = recalls.mean()
+      results[name] = {'ar': ar, 'recalls': recalls, 'thresholds': thresholds,
+                       'gt_overlaps': area_overlaps}
+    if isinstance(area, str):
+      return results[area]
+    return results
 
   def create_roidb_from_box_list(self, box_list, gt_roidb):
     assert len(box_list) == self.num_images, \
@@ -232,8 +391,7 @@ class imdb(object):
       if gt_roidb is not None and gt_roidb[i]['boxes'].size > 0:
         gt_boxes = gt_roidb[i]['boxes']
         gt_classes = gt_roidb[i]['gt_classes']
-        gt_overlaps = bbox_overlaps(boxes.astype(np.float),
-                                    gt_boxes.astype(np.float))
+        gt_overlaps = bbox_overlaps(boxes, gt_boxes)
         argmaxes = gt_overlaps.argmax(axis=1)
         maxes = gt_overlaps.max(axis=1)
         I = np.where(maxes > 0)[0]
@@ -254,6 +412,9 @@ class imdb(object):
   def merge_roidbs(a, b):
     assert len(a) == len(b)
     for i in range(len(a)):
+      # ground truth only entries have no gt_overlaps, they are one-hot at their class
+      if 'gt_overlaps' not in a[i]:
+        a[i]['gt_overlaps'] = one_hot_overlaps(a[i]['gt_classes'], b[i]['gt_overlaps'].shape[1])
       a[i]['boxes'] = np.vstack((a[i]['boxes'], b[i]['boxes']))
       a[i]['gt_classes'] = np.hstack((a[i]['gt_classes'],
                                       b[i]['gt_classes']))
@@ -61,6 +61,8 @@ class musicma(imdb):
                        'use_salt': True,
                        'use_diff': False,
                        'matlab_eval': False,
+                       # value the inference pads images with, white paper
+                       'pad_value': 255,
                        'rpn_file': None}
 
         assert os.path.exists(self._devkit_path), \
@@ -121,25 +123,16 @@ class musicma(imdb):
     def gt_roidb(self):
         """
         Return the database of ground-truth regions of interest.
-        This function loads/saves from/to a cache file to speed up future calls.
+        This function loads/saves from/to a cache file to speed up future calls,
+        only new or changed annotation files are parsed again.
         """
-        cache_file = os.path.join(self.cache_path, self.name + '_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                try:
-                    roidb = pickle.load(fid)
-                except:
-                    roidb = pickle.load(fid, encoding='bytes')
-            print('{} gt roidb loaded from {}'.format(self.name, cache_file))
-            return roidb
-
-        gt_roidb = [self._load_musical_annotation(index)
-                    for index in self.image_index]
-        with open(cache_file, 'wb') as fid:
-            pickle.dump(gt_roidb, fid, pickle.HIGHEST_PROTOCOL)
-        print('wrote gt roidb to {}'.format(cache_file))
+        return self.cached_gt_roidb('_load_musical_annotation')
 
-        return gt_roidb
+    def annotation_path(self, index):
+        """
+        Return the path of the annotation file of an image index.
+        """
+        return os.path.join(self._data_path, 'xml_annotations', index + '.xml')
 
     def rpn_roidb(self):
         if int(self._year) == 2017 or self._image_set != 'test':
@@ -166,13 +159,12 @@ class musicma(imdb):
         """
         muscima = True
         rescale_factor = 1
-        filename = os.path.join(self._data_path, 'xml_annotations', index + '.xml')
+        filename = self.annotation_path(index)
         objs = parse_rec(filename, muscima=muscima, rescale_factor=rescale_factor)
         num_objs = len(objs)
 
         boxes = np.zeros((num_objs, 4), dtype=np.uint16)
         gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.num_classes), dtype=np.float32)
         # "Seg" area for pascal is just the box area
         seg_areas = np.zeros((num_objs), dtype=np.float32)
 
@@ -189,14 +181,10 @@ class musicma(imdb):
                     cls = self._class_to_ind[objs[ix]['name'].lower().strip()]
                 boxes[ix, :] = [x1, y1, x2, y2]
                 gt_classes[ix] = cls
-                overlaps[ix, cls] = 1.0
                 seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
 
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-
         return {'boxes': boxes,
                 'gt_classes': gt_classes,
-                'gt_overlaps': overlaps,
                 'flipped': False,
                 'seg_areas': seg_areas}
 
@@ -10,8 +10,15 @@ from __future__ import print_function
 import xml.etree.ElementTree as ET
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 from PIL import Image
+from datasets.detection_store import ClassDetections
+from datasets.gt_index import GTIndex
+
+# ground truth of the evaluation worker processes, set once per worker
+worker_roidb = None
 
 def parse_rec(filename, muscima, rescale_factor=1):
   """ Parse a PASCAL VOC xml file """
@@ -58,8 +65,12 @@ def parse_rec_deepscores(filename, rescale_factor=0.5):
   tree = ET.parse(filename)
   objects = []
 
-  # get image size to scale gt bbox
-  im_size = Image.open(filename.replace("xml_annotations", "images_png")[:-4] + ".png").convert('L').size
+  # get image size to scale gt bbox, from the annotation or else from the png header
+  size = tree.find('size')
+  if size is not None:
+    im_size = (int(size.find('width').text), int(size.find('height').text))
+  else:
+    im_size = Image.open(filename.replace("xml_annotations", "images_png")[:-4] + ".png").size
   for obj in tree.findall('object'):
     obj_struct = {}
     obj_struct['name'] = obj.find('name').text
@@ -77,8 +88,6 @@ def parse_rec_deepscores(filename, rescale_factor=0.5):
     obj_struct['bbox'][2] = int(round(float(obj_struct['bbox'][2]) * im_size[0]))
     obj_struct['bbox'][3] = int(round(float(obj_struct['bbox'][3]) * im_size[1]))
     objects.append(obj_struct)
-    with open('bounding_boxes.pickle', 'w') as f:
-      pickle.dump(objects, f)
 
   return objects
 
@@ -137,8 +146,7 @@ def voc_ap(rec, prec, use_07_metric=False):
     mpre = np.concatenate(([0.], prec, [0.]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-      mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -149,7 +157,7 @@ def voc_ap(rec, prec, use_07_metric=False):
   return ap
 
 
-def voc_eval(detpath,
+def voc_eval(detections,
              # annopath,
              # imagesetfile,
              # cachedir,
@@ -159,158 +167,46 @@ def voc_eval(detpath,
              classind,
              ovthresh=0.5,
              use_07_metric=False):
-  """rec, prec, ap = voc_eval(detpath,
-                              annopath,
-                              imagesetfile,
+  """rec, prec, ap = voc_eval(detections,
+                              roidb,
+                              pair,
                               classname,
+                              classind,
                               [ovthresh],
                               [use_07_metric])
   Top level function that does the PASCAL VOC evaluation.
-  detpath: Path to detections
-      detpath.format(classname) should produce the detection results file.
-  annopath: Path to annotations
-      annopath.format(imagename) should be the xml annotations file.
-  imagesetfile: Text file containing the list of images, one image per line.
+  detections: Detections of this class, either
+      the list over images of all_boxes[classind] (each element [] or an
+      array of shape #dets x 5, columns x1, y1, x2, y2, score) or
+      the path to a results file, detections.format(classname) should
+      produce the detection results file.
+  roidb: Ground truth, the roidb of the evaluated imdb or its GTIndex
+      (results files can only be read with the roidb)
+  pair: Which entry of paired roidb entries to use
   classname: Category name (duh)
-  cachedir: Directory for caching the annotations
+  classind: Index of the category in gt_classes
   [ovthresh]: Overlap threshold (default = 0.5)
   [use_07_metric]: Whether to use VOC07's 11 point AP computation
       (default False)
   """
-  # assumes detections are in detpath.format(classname)
-  # assumes annotations are in annopath.format(imagename)
-  # assumes imagesetfile is a text file with each line an image name
-  # cachedir caches the annotations in a pickle file
-
-  # if classname == "notehead-full":
-  #   print("nh-full")
-  #
-  # # first load gt
-  # if not os.path.isdir(cachedir):
-  #   os.mkdir(cachedir)
-  # cachefile = os.path.join(cachedir, '%s_annots.pkl' % imagesetfile)
-  # # read list of images
-  # with open(imagesetfile, 'r') as f:
-  #   lines = f.readlines()
-  # imagenames = [x.strip() for x in lines]
-  #
-  # # remove files not present on disk
-  # present_files = os.listdir(annopath[:-9])
-  # present_files = set([x[:-4] for x in present_files])
-  # imagenames = set(imagenames)
-  # imagenames = list(imagenames.intersection(present_files))
-  #
-  # if not os.path.isfile(cachefile):
-  #   # load annotations
-  #   recs = {}
-  #   for i, imagename in enumerate(imagenames):
-  #     if "DeepScores" in detpath:
-  #       recs[imagename] = parse_rec_deepscores(annopath.format(imagename))
-  #     elif "MUSICMA" in detpath:
-  #       recs[imagename] = parse_rec(annopath.format(imagename), muscima = True)
-  #
-  #     elif "Dota" in detpath:
-  #       recs[imagename] = parse_rec_dota(annopath.format(imagename))
-  #
-  #     else:
-  #       recs[imagename] = parse_rec(annopath.format(imagename), musicma = False)
-  #     if i % 100 == 0:
-  #       print('Reading annotation for {:d}/{:d}'.format(
-  #         i + 1, len(imagenames)))
-  #   # save
-  #   print('Saving cached annotations to {:s}'.format(cachefile))
-  #   with open(cachefile, 'w') as f:
-  #     pickle.dump(recs, f)
-  # else:
-  #   # load
-  #   with open(cachefile, 'rb') as f:
-  #     try:
-  #       recs = pickle.load(f)
-  #     except:
-  #       recs = pickle.load(f, encoding='bytes')
-
   # extract gt objects for this class
-  class_recs = {}
-  npos = 0
-  for roidb_ind, roidb_entry in enumerate(roidb):
-    roidb_entry = roidb_entry[pair]
-    imagename = roidb_entry["semseg_path"].split("/")[-1][:-4]
-    #R = [obj for obj in recs[imagename] if obj['name'] == classname]
-    #bbox = np.array([x['bbox'] for x in R])
-    # if len(R) == 0:
-    #   continue
-    bbox = roidb_entry["boxes"][roidb_entry["gt_classes"] == classind]
-    R = list([*bbox])
-
-
-    if len(R) > 0 and R[0].__class__ != dict or "difficult" not in R[0].keys():
-      difficult = np.zeros(len(R)).astype(np.bool)
-    else:
-      difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-
-    det = [False] * len(R)
-    npos = npos + sum(~difficult)
-    class_recs[imagename] = {'bbox': bbox,
-                             'difficult': difficult,
-                             'det': det}
+  gt_boxes, gt_difficult, npos = class_ground_truth(roidb, pair, classind)
 
   # read dets
-  detfile = detpath.format(classname)
-  with open(detfile, 'r') as f:
-    lines = f.readlines()
+  if isinstance(detections, str):
+    image_ids, confidence, BB = read_detections_file(detections.format(classname), roidb, pair)
+  else:
+    image_ids, confidence, BB = stack_detections(detections)
 
-  splitlines = [x.strip().split(' ') for x in lines]
-  image_ids = [x[0] for x in splitlines]
-  confidence = np.array([float(x[1]) for x in splitlines])
-  BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
-
-  nd = len(image_ids)
-  tp = np.zeros(nd)
-  fp = np.zeros(nd)
-
-  if BB.shape[0] > 0:
-    # sort by confidence
-    sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
-    BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    for d in range(nd):
-      R = class_recs[image_ids[d]]
-      bb = BB[d, :].astype(float)
-      ovmax = -np.inf
-      BBGT = R['bbox'].astype(float)
-
-      if BBGT.size > 0:
-        # compute overlaps
-        # intersection
-        ixmin = np.maximum(BBGT[:, 0], bb[0])
-        iymin = np.maximum(BBGT[:, 1], bb[1])
-        ixmax = np.minimum(BBGT[:, 2], bb[2])
-        iymax = np.minimum(BBGT[:, 3], bb[3])
-        iw = np.maximum(ixmax - ixmin + 1., 0.)
-        ih = np.maximum(iymax - iymin + 1., 0.)
-        inters = iw * ih
-
-        # union
-        uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-               (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-               (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-        overlaps = inters / uni
-        ovmax = np.max(overlaps)
-        jmax = np.argmax(overlaps)
-
-      if ovmax > ovthresh:
-        if not R['difficult'][jmax]:
-          if not R['det'][jmax]:
-            tp[d] = 1.
-            R['det'][jmax] = 1
-          else:
-            fp[d] = 1.
-      else:
-        fp[d] = 1.
+  # sort by confidence, ties keep the image order
+  sorted_ind = np.argsort(-confidence, kind='mergesort')
+  BB = BB[sorted_ind, :]
+  image_ids = image_ids[sorted_ind]
+
+  # go down dets and mark TPs and FPs
+  ovmax, jmax = best_overlaps(image_ids, BB, gt_boxes)
+  difficult = np.concatenate([np.zeros(0, dtype=bool)] + gt_difficult)
+  tp, fp = greedy_match(ovmax, jmax, difficult, ovthresh)
 
   # compute precision recall
   fp = np.cumsum(fp)
@@ -322,3 +218,376 @@ def voc_eval(detpath,
   ap = voc_ap(rec, prec, use_07_metric)
 
   return rec, prec, ap
+
+
+def voc_eval_table(detections,
+                   roidb,
+                   pair,
+                   classnames,
+                   classinds,
+                   ovthresh_list,
+                   use_07_metric=False,
+                   num_workers=1):
+  """aps, recs, precs = voc_eval_table(detections,
+                                       roidb,
+                                       pair,
+                                       classnames,
+                                       classinds,
+                                       ovthresh_list,
+                                       [use_07_metric],
+                                       [num_workers])
+  PASCAL VOC evaluation of several classes at several overlap thresholds.
+  Every class is matched once for all thresholds, see voc_eval_thresholds.
+  detections: List with the detections of every class (see voc_eval)
+  classnames, classinds: Names and gt_classes indices of the classes
+  ovthresh_list: Overlap thresholds
+  [num_workers]: Number of processes the classes are distributed over
+      (default 1, evaluate in this process)
+  returns aps: Array of shape #thresholds x #classes
+          recs, precs: Nested lists indexed [threshold][class]
+  """
+  if num_workers is not None and num_workers > 1 and len(classinds) > 1:
+    # the workers only get the ground truth part of the roidb, once each
+    if isinstance(roidb, GTIndex):
+      gt_roidb = roidb
+    else:
+      gt_roidb = [dict((key, value) for key, value in pair_entry(roidb_entry, pair).items()
+                       if key in ["boxes", "gt_classes", "semseg_path"])
+                  for roidb_entry in roidb]
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(classinds)),
+                             initializer=init_eval_worker, initargs=(gt_roidb,)) as pool:
+      results = list(pool.map(eval_worker, detections, classnames, classinds,
+                              repeat(ovthresh_list), repeat(use_07_metric)))
+  else:
+    results = [voc_eval_thresholds(dets, roidb, pair, classname, classind, ovthresh_list, use_07_metric)
+               for dets, classname, classind in zip(detections, classnames, classinds)]
+
+  aps = np.zeros((len(ovthresh_list), len(classinds)))
+  recs = [[None] * len(classinds) for _ in ovthresh_list]
+  precs = [[None] * len(classinds) for _ in ovthresh_list]
+  for c, (cls_recs, cls_precs, cls_aps) in enumerate(results):
+    aps[:, c] = cls_aps
+    for t in range(len(ovthresh_list)):
+      recs[t][c] = cls_recs[t]
+      precs[t][c] = cls_precs[t]
+  return aps, recs, precs
+
+
+def init_eval_worker(gt_roidb):
+  """ Stores the ground truth in the worker process """
+  global worker_roidb
+  worker_roidb = gt_roidb
+
+
+def eval_worker(detections, classname, classind, ovthresh_list, use_07_metric):
+  """ voc_eval_thresholds of one class on the ground truth of the worker """
+  return voc_eval_thresholds(detections, worker_roidb, 0, classname, classind,
+                             ovthresh_list, use_07_metric)
+
+
+def voc_eval_thresholds(detections,
+                        roidb,
+                        pair,
+                        classname,
+                        classind,
+                        ovthresh_list,
+                        use_07_metric=False):
+  """recs, precs, aps = voc_eval_thresholds(detections,
+                                            roidb,
+                                            pair,
+                                            classname,
+                                            classind,
+                                            ovthresh_list,
+                                            [use_07_metric])
+  Same as voc_eval for a list of overlap thresholds. The overlaps of the
+  detections with the ground truth of their image are computed once, the
+  greedy matching of all thresholds is derived from them.
+  returns recs, precs: Lists over the thresholds
+          aps: Array over the thresholds
+  """
+  gt_boxes, gt_difficult, npos = class_ground_truth(roidb, pair, classind)
+
+  # read dets
+  if isinstance(detections, str):
+    image_ids, confidence, BB = read_detections_file(detections.format(classname), roidb, pair)
+  else:
+    image_ids, confidence, BB = stack_detections(detections)
+
+  # sort by confidence, ties keep the image order
+  sorted_ind = np.argsort(-confidence, kind='mergesort')
+  BB = BB[sorted_ind, :]
+  image_ids = image_ids[sorted_ind]
+
+  ovmax, jmax = best_overlaps(image_ids, BB, gt_boxes)
+  difficult = np.concatenate([np.zeros(0, dtype=bool)] + gt_difficult)
+
+  recs, precs, aps = [], [], np.zeros(len(ovthresh_list))
+  for t, ovthresh in enumerate(ovthresh_list):
+    tp, fp = greedy_match(ovmax, jmax, difficult, ovthresh)
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    recs.append(rec)
+    precs.append(prec)
+    aps[t] = voc_ap(rec, prec, use_07_metric)
+
+  return recs, precs, aps
+
+
+class StreamingEvaluator(object):
+  """
+  PASCAL VOC evaluation that is fed image by image while the inference runs.
+  The detections of an image are matched to its ground truth right away,
+  per class only the scores and the true / false positive flags at every
+  overlap threshold are kept. evaluate() gives the same table as
+  voc_eval_table on the detections of all added images.
+  """
+
+  def __init__(self, gt_index, classnames, classinds, ovthresh_list, use_07_metric=False):
+    """
+    inputs:
+      gt_index - GTIndex of the evaluated imdb
+      classnames, classinds - names and gt_classes indices of the evaluated classes
+      ovthresh_list - overlap thresholds
+      use_07_metric - whether to use VOC07's 11 point AP computation
+    """
+    self.gt_index = gt_index
+    self.classnames = classnames
+    self.classinds = classinds
+    self.ovthresh_list = ovthresh_list
+    self.use_07_metric = use_07_metric
+    self.num_images = 0
+    self.npos = np.zeros(len(classinds), dtype=np.int64)
+    self.scores = [[] for _ in classinds]
+    self.tp = [[] for _ in classinds]
+    self.fp = [[] for _ in classinds]
+
+  def add_image(self, image, detections):
+    """
+    Matches the detections of one image, images have to be added in the imdb order
+    inputs:
+      image - index of the image in the imdb
+      detections - detections[classind] is [] or an array of shape #dets x 5 (x1, y1, x2, y2, score)
+    """
+    rows = self.gt_index.image_slice(image)
+    image_boxes = self.gt_index.boxes[rows]
+    image_classes = self.gt_index.classes[rows]
+    for c, classind in enumerate(self.classinds):
+      gt_boxes = image_boxes[image_classes == classind]
+      self.npos[c] += len(gt_boxes)
+
+      dets = detections[classind]
+      if len(dets) == 0:
+        continue
+      # same conventions as voc_eval
+      image_ids, confidence, BB = stack_detections([dets])
+      sorted_ind = np.argsort(-confidence, kind='mergesort')
+      ovmax, jmax = best_overlaps(image_ids, BB[sorted_ind], [gt_boxes])
+      difficult = np.zeros(len(gt_boxes), dtype=bool)
+      matches = [greedy_match(ovmax, jmax, difficult, ovthresh) for ovthresh in self.ovthresh_list]
+
+      self.scores[c].append(confidence[sorted_ind])
+      self.tp[c].append(np.array([tp for tp, _ in matches], dtype=bool).reshape(-1, len(BB)))
+      self.fp[c].append(np.array([fp for _, fp in matches], dtype=bool).reshape(-1, len(BB)))
+    self.num_images += 1
+
+  def evaluate(self):
+    """
+    aps, recs, precs = evaluate()
+    Evaluation of the images added so far, as returned by voc_eval_table
+    """
+    nr_thresh = len(self.ovthresh_list)
+    aps = np.zeros((nr_thresh, len(self.classinds)))
+    recs = [[None] * len(self.classinds) for _ in self.ovthresh_list]
+    precs = [[None] * len(self.classinds) for _ in self.ovthresh_list]
+    for c in range(len(self.classinds)):
+      scores = np.concatenate([np.zeros(0)] + self.scores[c])
+      sorted_ind = np.argsort(-scores, kind='mergesort')
+      tp_all = np.concatenate([np.zeros((nr_thresh, 0), dtype=bool)] + self.tp[c], axis=1)[:, sorted_ind]
+      fp_all = np.concatenate([np.zeros((nr_thresh, 0), dtype=bool)] + self.fp[c], axis=1)[:, sorted_ind]
+      for t in range(nr_thresh):
+        # compute precision recall
+        fp = np.cumsum(fp_all[t], dtype=np.float64)
+        tp = np.cumsum(tp_all[t], dtype=np.float64)
+        rec = tp / float(self.npos[c])
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        recs[t][c] = rec
+        precs[t][c] = prec
+        aps[t, c] = voc_ap(rec, prec, self.use_07_metric)
+    return aps, recs, precs
+
+  def mean_ap(self):
+    """ mAP per overlap threshold of the images added so far, classes without objects are left out """
+    with np.errstate(invalid='ignore', divide='ignore'):
+      aps = self.evaluate()[0]
+    present = self.npos > 0
+    if not present.any():
+      return np.zeros(len(self.ovthresh_list))
+    return aps[:, present].mean(axis=1)
+
+
+def class_ground_truth(roidb, pair, classind):
+  """ gt_boxes, gt_difficult, npos = class_ground_truth(roidb, pair, classind)
+  Per image ground truth boxes (float) and difficult flags of one class
+  and the number of non difficult objects.
+  """
+  if isinstance(roidb, GTIndex):
+    return roidb.class_ground_truth(classind)
+
+  gt_boxes, gt_difficult = [], []
+  for roidb_entry in roidb:
+    roidb_entry = pair_entry(roidb_entry, pair)
+    bbox = roidb_entry["boxes"][roidb_entry["gt_classes"] == classind]
+    gt_boxes.append(np.asarray(bbox, dtype=np.float64).reshape(-1, 4))
+    gt_difficult.append(np.zeros(len(bbox), dtype=bool))
+  npos = sum(len(d) - np.sum(d) for d in gt_difficult)
+  return gt_boxes, gt_difficult, npos
+
+
+def best_overlaps(image_ids, BB, gt_boxes, max_pairs=2**22):
+  """ ovmax, jmax = best_overlaps(image_ids, BB, gt_boxes, [max_pairs])
+  Best overlap of every detection with the ground truth of its image and
+  the index of that object, numbered across all images (ovmax is -inf if
+  the image has no ground truth, ties go to the first object like argmax).
+  All images are processed at once: the ground truth is sorted by image
+  and left edge, so the objects a detection can intersect form a range
+  found by binary search and only those pairs are computed, in chunks of
+  at most max_pairs.
+  """
+  gt_counts = np.array([len(b) for b in gt_boxes], dtype=np.int64)
+  gt_offsets = np.concatenate(([0], np.cumsum(gt_counts)))
+  ovmax = np.where(gt_counts[image_ids] > 0, 0., -np.inf)
+  jmax = gt_offsets[image_ids]
+  if len(image_ids) == 0 or gt_offsets[-1] == 0:
+    return ovmax, jmax
+
+  BBGT = np.concatenate(gt_boxes)
+  gt_image = np.repeat(np.arange(len(gt_boxes)), gt_counts)
+
+  # sweep line keys, the span keeps the keys of different images apart
+  max_width = np.max(BBGT[:, 2] - BBGT[:, 0])
+  origin = min(BBGT[:, 0].min(), BB[:, 0].min())
+  span = max(BBGT[:, 2].max(), BB[:, 2].max()) - origin + max_width + 1
+  order = np.lexsort((BBGT[:, 0], gt_image))
+  keys = gt_image[order] * span + (BBGT[order, 0] - origin)
+  lo = np.searchsorted(keys, image_ids * span + (BB[:, 0] - origin - max_width), 'left')
+  hi = np.searchsorted(keys, image_ids * span + (BB[:, 2] - origin), 'right')
+  counts = hi - lo
+
+  # split the detections into chunks with a bounded number of pairs
+  ends = np.cumsum(counts)
+  bounds = [0]
+  while bounds[-1] < len(counts):
+    limit = (ends[bounds[-1] - 1] if bounds[-1] > 0 else 0) + max_pairs
+    bounds.append(max(int(np.searchsorted(ends, limit, 'right')), bounds[-1] + 1))
+
+  for chunk_start, chunk_end in zip(bounds[:-1], bounds[1:]):
+    chunk_counts = counts[chunk_start:chunk_end]
+    total = int(chunk_counts.sum())
+    if total == 0:
+      continue
+    det_idx = np.repeat(np.arange(chunk_start, chunk_end), chunk_counts)
+    first_pair = np.cumsum(chunk_counts) - chunk_counts
+    gt_idx = order[np.repeat(lo[chunk_start:chunk_end] - first_pair, chunk_counts) + np.arange(total)]
+    overlaps = paired_overlaps(BB[det_idx], BBGT[gt_idx])
+
+    # best pair of every detection, the lowest object index wins ties
+    positive = overlaps > 0
+    det_idx, gt_idx, overlaps = det_idx[positive], gt_idx[positive], overlaps[positive]
+    best = np.lexsort((gt_idx, -overlaps, det_idx))
+    first = best[np.diff(det_idx[best], prepend=-1) != 0]
+    ovmax[det_idx[first]] = overlaps[first]
+    jmax[det_idx[first]] = gt_idx[first]
+  return ovmax, jmax
+
+
+def paired_overlaps(boxes, gt_boxes):
+  """ overlaps = paired_overlaps(boxes, gt_boxes)
+  IoU of boxes[k] and gt_boxes[k] for all k in the VOC convention
+  (inclusive pixel coordinates).
+  """
+  # intersection
+  ixmin = np.maximum(gt_boxes[:, 0], boxes[:, 0])
+  iymin = np.maximum(gt_boxes[:, 1], boxes[:, 1])
+  ixmax = np.minimum(gt_boxes[:, 2], boxes[:, 2])
+  iymax = np.minimum(gt_boxes[:, 3], boxes[:, 3])
+  iw = np.maximum(ixmax - ixmin + 1., 0.)
+  ih = np.maximum(iymax - iymin + 1., 0.)
+  inters = iw * ih
+
+  # union
+  uni = ((boxes[:, 2] - boxes[:, 0] + 1.) * (boxes[:, 3] - boxes[:, 1] + 1.) +
+         (gt_boxes[:, 2] - gt_boxes[:, 0] + 1.) *
+         (gt_boxes[:, 3] - gt_boxes[:, 1] + 1.) - inters)
+  return inters / uni
+
+
+def greedy_match(ovmax, jmax, difficult, ovthresh):
+  """ tp, fp = greedy_match(ovmax, jmax, difficult, ovthresh)
+  Marks the detections (sorted by confidence) as true or false positives.
+  A detection is a true positive if it is the first one whose best
+  overlap with a ground truth object exceeds ovthresh, later ones are
+  false positives, matches of difficult objects count as neither.
+  """
+  tp = np.zeros(len(ovmax))
+  fp = np.zeros(len(ovmax))
+  hit = ovmax > ovthresh
+  fp[~hit] = 1.
+  candidates = np.where(hit)[0]
+  candidates = candidates[~difficult[jmax[candidates]]]
+  _, first = np.unique(jmax[candidates], return_index=True)
+  tp[candidates[first]] = 1.
+  fp[candidates] = 1. - tp[candidates]
+  return tp, fp
+
+
+def pair_entry(roidb_entry, pair):
+  """ Paired datasets store a list of roidb entries per image """
+  if isinstance(roidb_entry, list):
+    return roidb_entry[pair]
+  return roidb_entry
+
+
+def stack_detections(detections):
+  """ image_ids, confidence, BB = stack_detections(all_boxes[classind])
+  Flattens the per image detections of one class into arrays.
+  The boxes are shifted to the 1-based coordinates of the results files.
+  """
+  if isinstance(detections, ClassDetections):
+    image_ids, confidence, BB = detections.stack()
+    return image_ids, confidence, BB + 1
+
+  image_ids = [np.full(len(dets), im_ind, dtype=np.int64)
+               for im_ind, dets in enumerate(detections) if len(dets) > 0]
+  dets = [np.asarray(dets, dtype=np.float64).reshape(len(dets), -1)
+          for dets in detections if len(dets) > 0]
+  if len(dets) == 0:
+    return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 4))
+
+  dets = np.concatenate(dets)
+  return np.concatenate(image_ids), dets[:, -1], dets[:, :4] + 1
+
+
+def read_detections_file(detfile, roidb, pair):
+  """ image_ids, confidence, BB = read_detections_file(detfile, roidb, pair)
+  Reads a results file as written by _write_voc_results_file, the image
+  names are mapped to roidb indices.
+  """
+  name_to_ind = dict()
+  for roidb_ind, roidb_entry in enumerate(roidb):
+    imagename = pair_entry(roidb_entry, pair)["semseg_path"].split("/")[-1][:-4]
+    name_to_ind[imagename] = roidb_ind
+
+  with open(detfile, 'r') as f:
+    lines = f.readlines()
+
+  splitlines = [x.strip().split(' ') for x in lines]
+  image_ids = np.array([name_to_ind[x[0]] for x in splitlines], dtype=np.int64)
+  confidence = np.array([float(x[1]) for x in splitlines])
+  BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
+  return image_ids, confidence, BB
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark for the post-processing stages of perform_dws on synthetic energy maps.
+
+usage: python main/benchmark_dws.py (from the lib directory)
+"""
+import os
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))[:-4])
+from main.dws_transform import filter_small_components, split_fused_components
+
+
+def synthetic_energy(nr_components, shape=(2000, 1500), max_energy=20, seed=314):
+    """
+    Builds an energy map with nr_components pyramid shaped blobs of random size, similar to the
+    output of the energy head on a dense score page.
+    """
+    rng = np.random.RandomState(seed)
+    energy = np.zeros(shape, dtype=np.int64)
+    for _ in range(nr_components):
+        r = rng.randint(1, 10)
+        y = rng.randint(r, shape[0] - r)
+        x = rng.randint(r, shape[1] - r)
+        yy, xx = np.mgrid[-r:r + 1, -r:r + 1]
+        blob = np.maximum(max_energy - 1 - (np.abs(yy) + np.abs(xx)) * (max_energy // (r + 1)), 0)
+        patch = energy[y - r:y + r + 1, x - r:x + r + 1]
+        np.maximum(patch, blob, out=patch)
+    return energy
+
+
+def legacy_filter(labels, retval, min_ccoponent_size):
+    labels = labels.copy()
+    for comp in range(1, retval):
+        if np.sum(labels == comp) < min_ccoponent_size:
+            labels[labels == comp] = 0
+    return labels
+
+
+def time_call(fn, *args):
+    start = time.time()
+    res = fn(*args)
+    return res, time.time() - start
+
+
+def bench_filter(nr_components_list, cutoff=7, min_ccoponent_size=10):
+    print("component filtering")
+    print("{:>10} {:>10} {:>12} {:>12} {:>8}".format("requested", "found", "legacy [s]", "lut [s]", "equal"))
+    for nr_components in nr_components_list:
+        binar_energy = ((synthetic_energy(nr_components) > cutoff) * 255).astype(np.uint8)
+        retval, labels, stats, _ = cv2.connectedComponentsWithStats(binar_energy)
+
+        legacy, t_legacy = time_call(legacy_filter, labels, retval, min_ccoponent_size)
+        fast, t_fast = time_call(filter_small_components, labels, stats[:, cv2.CC_STAT_AREA], min_ccoponent_size)
+
+        print("{:>10d} {:>10d} {:>12.4f} {:>12.4f} {:>8}".format(
+            nr_components, retval - 1, t_legacy, t_fast, str(np.array_equal(legacy, fast))))
+
+
+def bench_split(nr_components_list, cutoff=7, min_ccoponent_size=10, fatten_cutoff=1):
+    print("fused component splitting")
+    print("{:>10} {:>10} {:>10} {:>12}".format("requested", "fattened", "fused", "split [s]"))
+    for nr_components in nr_components_list:
+        energy = synthetic_energy(nr_components)
+        retval, labels, stats, _ = cv2.connectedComponentsWithStats(((energy > cutoff) * 255).astype(np.uint8))
+        labels = filter_small_components(labels, stats[:, cv2.CC_STAT_AREA], min_ccoponent_size)
+        retval_0, labels_0 = cv2.connectedComponents(((energy > fatten_cutoff) * 255).astype(np.uint8))
+
+        overlap = (labels_0 != 0) & (labels != 0)
+        pairs = np.unique(np.stack([labels_0[overlap], labels[overlap]]), axis=1)
+        seeds_per_comp = np.bincount(pairs[0], minlength=retval_0)
+        _, t_split = time_call(split_fused_components, labels, labels_0, retval_0)
+
+        print("{:>10d} {:>10d} {:>10d} {:>12.4f}".format(
+            nr_components, retval_0 - 1, int(np.sum(seeds_per_comp > 1)), t_split))
+
+
+if __name__ == '__main__':
+    bench_filter([10, 100, 500, 1000, 2000, 5000])
+    bench_split([10, 100, 500, 1000, 2000, 5000])
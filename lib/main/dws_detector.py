@@ -1,11 +1,12 @@
 from __future__ import print_function
 import numpy as np
 import tensorflow as tf
-from models.dwd_net import build_dwd_net
-from main.dws_transform import perform_dws
+from models.dwd_net import build_dwd_net, compact_energy_output
+from main.dws_transform import perform_dws, perform_dws_batch
 from PIL import Image
 #from main.config import cfg
 from datasets import fcn_groundtruth
+from utils.blob import im_list_to_blob
 import scipy.special as sc
 
 
@@ -13,11 +14,40 @@ np.random.seed(314)
 tf.set_random_seed(314)
 
 
+def tile_layout(length, tile_size, overlap):
+    """
+    Splits one image axis into overlapping tiles of tile_size pixels (the last tile is aligned to the image border).
+    Each pixel is owned by exactly one tile, seams are placed in the middle of the overlaps.
+    returns:
+        list of (tile_start, own_start, own_end)
+    """
+    if length <= tile_size:
+        return [(0, 0, length)]
+
+    stride = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size + 1, stride))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+
+    # seam between tile k and k+1 in the middle of their overlap
+    seams = [0] + [(starts[k + 1] + starts[k] + tile_size) // 2 for k in range(len(starts) - 1)] + [length]
+    return [(start, seams[k], seams[k + 1]) for k, start in enumerate(starts)]
+
+
 class DWSDetector:
-    def __init__(self, parsed, path, imdb):
+    def __init__(self, parsed, path, imdb, dws_workers=None, mask_cutoffs=None, pad_value=None):
         self.model_path = path
         self.config = parsed
         self.imdb = imdb
+        # number of threads used to post-process the paired outputs, None uses one per pair
+        self.dws_workers = dws_workers
+        # (cutoff, fatten_cutoff) to threshold the energy on the graph, None fetches the energy levels
+        if mask_cutoffs is not None:
+            assert mask_cutoffs[1] < mask_cutoffs[0], \
+                'fatten_cutoff has to be below cutoff, got cutoff {} and fatten_cutoff {}'.format(*mask_cutoffs)
+        self.mask_cutoffs = mask_cutoffs
+        # value batched images are padded with, None takes the background of the dataset from its config
+        self.pad_value = imdb.config.get('pad_value', 0) if pad_value is None else pad_value
 
         self.saved_net = "backbone"
 
@@ -59,6 +89,23 @@ class DWSDetector:
         self.tf_session = self.sess
         self.counter = 0
 
+        # resolve the output tensors once, softmax heads are reduced to their argmax on the graph
+        # so only the small label maps are copied back to the host
+        self.fetch_list = []
+        for pair in range(self.config.paired_data):
+            for head in self.used_heads_loss:
+                output = self.network_heads[pair][head[0]][head[1]][-1]
+                if head[0] == "stamp_energy" and head[1] == "softmax":
+                    if self.mask_cutoffs is None:
+                        output = compact_energy_output(output)
+                    else:
+                        # 0: background, 1: above fatten_cutoff, 2: above cutoff
+                        output = compact_energy_output(output, [self.mask_cutoffs[1], self.mask_cutoffs[0]])
+                elif head[1] == "softmax":
+                    output = tf.cast(tf.argmax(output, axis=-1), tf.int8 if output.shape[-1].value < 128 else tf.int32)
+                self.fetch_list.append(output)
+        self.run_net = self.tf_session.make_callable(self.fetch_list, feed_list=[self.input])
+
     def classify_img(self, img, cutoff=0, min_ccoponent_size=0):
         """
         This function classifies an image based on the results of the net, has been tested with different values of cutoff and min_component_size and 
@@ -68,13 +115,21 @@ class DWSDetector:
             cutoff - the cutoff we do for the energy
             min_component_size - the minimum size of the connected component
         returns:
-            dws_list - the list of bounding boxes the dwdnet infers
+            paired_detect - per pair an (N, 5) array of the bounding boxes the dwdnet infers (xmin, ymin, xmax, ymax, class)
         """
-        if img.shape[0] > 1:
-            img = np.expand_dims(img, 0)
+        pred_dicts = self.predict(img)
+        self.counter += 1
+        return self.post_process(pred_dicts, cutoff, min_ccoponent_size)
 
-        if img.shape[-1] > 3:
-            img = np.expand_dims(img, -1)
+    def predict(self, img):
+        """
+        Runs the network on an image, this is the part of classify_img that uses the tensorflow session.
+        inputs:
+            img - the image, an ndarray
+        returns:
+            pred_dicts - per pair a dict with the network outputs used by perform_dws
+        """
+        img = self._prepare_input(img)
 
         # y_mulity = int(np.ceil(img.shape[1] / 160.0))
         # x_mulity = int(np.ceil(img.shape[2] / 160.0))
@@ -91,36 +146,108 @@ class DWSDetector:
         #import pickle
         #feed_train = pickle.load(open("feed_dict_train.pickle","rb"))
 
-        # create fetch list
-        print("create fetch list")
-        fetch_list = []
-
-        for pair in range(self.config.paired_data):
-            for head in self.used_heads_loss:
-                fetch_list.append(self.network_heads[pair][head[0]][head[1]][-1])
-
         #fetch_list = self.network_heads[0]["stamp_energy"]["softmax"]
         #img_test = np.stack((img[:,:,:,0], img[:,:,:,1], img[:,:,:,2]), -1)
 
-        preds = self.tf_session.run([fetch_list], feed_dict={self.input: img})
-        preds = preds[0]
-
-        print(np.unique(np.argmax(preds[0], axis=-1)))
+        # softmax outputs arrive as argmax label maps, see __init__
+        preds = self.run_net(img)
 
         #save_debug_panes(pred_energy, pred_class, pred_bbox,self.counter)
         #Image.fromarray(canv[0]).save(cfg.ROOT_DIR + "/output_images/" + "debug"+ 'input' + '.png')
 
-        # Apply softmax where necessary
-        i = 0
-        for pair in range(self.config.paired_data):
-            for head in self.used_heads_loss:
-                if head[1] == "softmax":
-                    preds[i] = np.argmax(preds[i], axis=-1)
-                i += 1
+        return self._to_pred_dicts(preds)
+
+    def classify_batch(self, imgs, cutoff=0, min_ccoponent_size=0, bucket_size=160, max_batch=4, pad_value=None):
+        """
+        Classifies a list of images with batched forward passes, see predict_batch.
+        returns:
+            list with the paired_detect of classify_img for every image, in input order
+        """
+        batch_preds = self.predict_batch(imgs, bucket_size, max_batch, pad_value)
+        self.counter += len(batch_preds)
+        return [self.post_process(pred_dicts, cutoff, min_ccoponent_size) for pred_dicts in batch_preds]
 
+    def predict_batch(self, imgs, bucket_size=160, max_batch=4, pad_value=None):
+        """
+        Runs the network on a list of images of different sizes. The images are grouped into buckets by their size
+        rounded up to a multiple of bucket_size, each bucket is padded to that size and run in batches of up to
+        max_batch images, the outputs are cropped back to the image sizes.
+        inputs:
+            imgs - list of images, ndarrays
+            bucket_size - granularity of the bucket shapes in pixels
+            max_batch - maximal number of images per forward pass
+            pad_value - value used to pad the images, a scalar or one value per channel, defaults to self.pad_value
+        returns:
+            list with the pred_dicts of predict for every image, in input order
+        """
+        if pad_value is None:
+            pad_value = self.pad_value
+        imgs = [self._prepare_input(img)[0] for img in imgs]
+
+        buckets = dict()
+        for ix, img in enumerate(imgs):
+            bucket_shape = tuple(int(np.ceil(x / float(bucket_size))) * bucket_size for x in img.shape[:2])
+            buckets.setdefault(bucket_shape, []).append(ix)
+
+        pred_dicts = [None] * len(imgs)
+        for bucket_shape, members in buckets.items():
+            for start in range(0, len(members), max_batch):
+                batch = members[start:start + max_batch]
+                blob = im_list_to_blob([imgs[ix] for ix in batch], pad_value=pad_value, min_shape=bucket_shape)
+                preds = self.run_net(blob)
+                for b, ix in enumerate(batch):
+                    height, width = imgs[ix].shape[:2]
+                    pred_dicts[ix] = self._to_pred_dicts([pred[b:b + 1, :height, :width] for pred in preds])
+
+        return pred_dicts
+
+    def predict_tiled(self, img, tile_size=2048, overlap=256, tile_batch=1):
+        """
+        Runs the network on a large image in overlapping tiles and stitches the outputs back together, so the memory
+        used by the network is bounded by the tile size. Every output pixel is taken from the tile in which it is
+        furthest from a seam, the watershed post-processing then runs on the stitched maps.
+        inputs:
+            img - the image, an ndarray
+            tile_size - edge length of the square tiles in pixels
+            overlap - number of pixels shared by neighbouring tiles, should cover the receptive field of the outputs
+            tile_batch - number of tiles per forward pass
+        returns:
+            pred_dicts - per pair a dict with the network outputs used by perform_dws, same as predict
+        """
+        img = self._prepare_input(img)[0]
+        height, width = img.shape[:2]
+        tiles_y = tile_layout(height, tile_size, overlap)
+        tiles_x = tile_layout(width, tile_size, overlap)
+        tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+        tiles = [(ty, tx) for ty in tiles_y for tx in tiles_x]
+
+        stitched = None
+        for start in range(0, len(tiles), tile_batch):
+            batch = tiles[start:start + tile_batch]
+            blob = np.stack([img[ty[0]:ty[0] + tile_height, tx[0]:tx[0] + tile_width] for ty, tx in batch])
+            preds = self.run_net(blob)
+            if stitched is None:
+                stitched = [np.zeros((1, height, width) + pred.shape[3:], dtype=pred.dtype) for pred in preds]
+
+            for b, ((y0, own_y0, own_y1), (x0, own_x0, own_x1)) in enumerate(batch):
+                for full, pred in zip(stitched, preds):
+                    full[0, own_y0:own_y1, own_x0:own_x1] = pred[b, own_y0 - y0:own_y1 - y0, own_x0 - x0:own_x1 - x0]
+
+        return self._to_pred_dicts(stitched)
+
+    def _prepare_input(self, img):
+        # add batch and channel dimension
+        if img.shape[0] > 1:
+            img = np.expand_dims(img, 0)
 
+        if img.shape[-1] > 3:
+            img = np.expand_dims(img, -1)
+        return img
+
+    def _to_pred_dicts(self, preds):
+        # sort the fetched outputs into one dict per pair
         i = 0
-        paired_detect = []
+        pred_dicts = []
         for pair in range(self.config.paired_data):
             pred_dict = {}
             for head in self.used_heads_loss:
@@ -131,10 +258,36 @@ class DWSDetector:
                 elif head[0] == "stamp_bbox" and self.config.bbox_estimation == "bbox_head":
                     pred_dict["stamp_bbox"] = preds[i]
                 i += 1
-            dws_list = perform_dws(pred_dict, cutoff, min_ccoponent_size,self.config)
-            paired_detect.append(dws_list)
+            pred_dicts.append(pred_dict)
 
-        self.counter += 1
+        return pred_dicts
+
+    def post_process(self, pred_dicts, cutoff=0, min_ccoponent_size=0):
+        """
+        Turns the network outputs of predict into bounding boxes, this is the part of classify_img that runs on the cpu.
+        It does not change the detector state, so it can run on several threads at once.
+        inputs:
+            pred_dicts - the output of predict
+            cutoff - the cutoff we do for the energy
+            min_component_size - the minimum size of the connected component
+        returns:
+            paired_detect - per pair an (N, 5) array of the bounding boxes (xmin, ymin, xmax, ymax, class)
+        """
+        fatten_cutoff = 1
+        if self.mask_cutoffs is not None:
+            # the energy has already been thresholded on the graph
+            assert cutoff == self.mask_cutoffs[0], \
+                'energy was thresholded at {} on the graph, got cutoff {}'.format(self.mask_cutoffs[0], cutoff)
+            cutoff, fatten_cutoff = 1, 0
+
+        if all(list(pred_dict.keys()) == ["stamp_energy"] for pred_dict in pred_dicts):
+            # energy only, post-process all pairs at once
+            energy_stack = np.stack([np.squeeze(pred_dict["stamp_energy"]) for pred_dict in pred_dicts])
+            paired_detect = perform_dws_batch(energy_stack, cutoff, min_ccoponent_size, fatten_cutoff, config=self.config,
+                                              num_workers=self.dws_workers)
+        else:
+            paired_detect = [perform_dws(pred_dict, cutoff, min_ccoponent_size, self.config, fatten_cutoff)
+                             for pred_dict in pred_dicts]
 
         return paired_detect
 
@@ -198,7 +351,7 @@ class DWSDetector:
         im_gt.show()
 
 
-    def save_images(self, config, data, predict_boxes, gt_boxes=None, text=False):
+    def save_images(self, config, data, predict_boxes, gt_boxes=None, text=False, index=None):
         """
         Utility function which saves the results of get_images.
         arguments:
@@ -206,21 +359,23 @@ class DWSDetector:
             boxes - boxes which we want to draw in the image.
             gt - set it to true if you want to also save the ground truth in addition to the results of the detector.
             text - set it to trye if you want to see also the classes of the classification/ground_truth in addition to bounding boxes.
-            counter - each image is given a name starting from 0.png, 1.png, ..., num_images.png
+            index - number in the file name, e.g. prediction0.png, defaults to the number of images classified so far
         returns:
             None
         """
+        if index is None:
+            index = self.counter
 
         if config.paired_data > 1:
             for i in range(config.paired_data):
                 im_pred = self.get_images(data[:, :, i], predict_boxes[i], gt_boxes, text)
 
-                im_pred.save(config.root_dir + "/output_images/inference/" + 'prediction' + str(self.counter) + "_" + str(i) + '.png')
+                im_pred.save(config.root_dir + "/output_images/inference/" + 'prediction' + str(index) + "_" + str(i) + '.png')
 
         else:
             im_pred = self.get_images(data, predict_boxes, gt_boxes, text)
 
-            im_pred.save(config.root_dir + "/output_images/inference/" + 'prediction' + str(self.counter) + '.png')
+            im_pred.save(config.root_dir + "/output_images/inference/" + 'prediction' + str(index) + '.png')
 
         return
 
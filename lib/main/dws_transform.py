@@ -1,14 +1,17 @@
-from PIL import Image, ImageDraw
-
+import os
 import sys
 import math, random
-from itertools import product
-from utils.ufarray import *
+from concurrent.futures import ThreadPoolExecutor
+from utils.ufarray import connected_components
 import numpy as np
-import cv2
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+from scipy import ndimage
 
 def perform_dws(predict_dict,cutoff=0,min_ccoponent_size=0, config=None,  fatten_cutoff= 1):
-    bbox_list = []
+    bbox_list = np.zeros((0, 5))
 
     dws_energy = np.squeeze(predict_dict["stamp_energy"])
 
@@ -31,11 +34,10 @@ def perform_dws(predict_dict,cutoff=0,min_ccoponent_size=0, config=None,  fatten
     #     if len(labels_inv[key]) < min_ccoponent_size:
     #         del labels_inv[key]
 
-    retval, labels = cv2.connectedComponents(binar_energy.astype(np.uint8))
+    retval, labels, areas = label_components(binar_energy.astype(np.uint8))
 
-    for comp in range(1,retval):
-        if np.sum(labels == comp) <  min_ccoponent_size:
-            labels[labels == comp] = 0
+    # filter components that are too small, sizes come from the same pass as the labeling
+    labels = filter_small_components(labels, areas, min_ccoponent_size)
 
 
 
@@ -51,64 +53,19 @@ def perform_dws(predict_dict,cutoff=0,min_ccoponent_size=0, config=None,  fatten
         print("boxes")
         # "fatten" the detected components using a cc analysis at cutoff 0
         binar_energy_0 = (dws_energy > fatten_cutoff) * 255
-        retval_0, labels_0 = cv2.connectedComponents(binar_energy_0.astype(np.uint8))
-        # iterate over cc_0 components
-        for i in range(1, retval_0):
-            support = np.unique(labels[labels_0 == i])
-            # remove bg
-            support = support[support != 0]
-            # remove unusported components
-            if len(support) > 0:
-                # do nothing for support 0
-                # replace pure components
-                if len(support) == 1:
-                    labels[labels_0 == i] = support[0]
-                # deal with fused components
-                else:
-                    print(support)
-
-                    coords_min = np.min(np.where(labels_0 == i), -1)
-                    coords_max = np.max(np.where(labels_0 == i), -1)
-
-                    patch = labels[coords_min[0]:coords_max[0], coords_min[1]:coords_max[1]]
-                    dist_list = list()
-                    for sup_ele in support:
-                        dist_map = ((patch == sup_ele)-1)*-1E6
-                        for direct in [1, -1, 2, -2]:
-                            shape = dist_map.shape[np.abs(direct)-1]
-                            if np.sign(direct) == 1:
-                                rng = range(1, shape)
-                            else:
-                                rng = range(shape-2, -1, -1)
-
-                            for ind in rng:
-                                if np.abs(direct) == 1:
-                                    dist_map[ind,:] = np.min(np.stack((dist_map[ind,:], dist_map[ind-np.sign(direct),:]+1),-1),-1)
-                                else:
-                                    dist_map[:,ind] = np.min(np.stack((dist_map[:,ind], dist_map[:,ind-np.sign(direct)]+1),-1),-1)
-                        dist_list.append(dist_map)
-                    dist_map = np.stack(dist_list, -1)
-                    min_dist = np.argmin(dist_map, -1)
-                    new_blobs = support[min_dist]
-                    update_pix = labels_0[coords_min[0]:coords_max[0], coords_min[1]:coords_max[1]] != 0
-
-                    # goal pane
-                    labels[coords_min[0]:coords_max[0], coords_min[1]:coords_max[1]][update_pix] = new_blobs[update_pix]
-
+        retval_0, labels_0, _ = label_components(binar_energy_0.astype(np.uint8))
+        # assign every fattened pixel to its nearest seed component
+        labels = split_fused_components(labels, labels_0, retval_0)
 
         print("axis estimation")
         # from PIL import Image
         # Image.fromarray(labels.astype(np.uint8)*3).save("cc_fat.jpg")
-        if config.bbox_angle == "estimated":
+        if config is not None and config.bbox_angle == "estimated":
             print("estimate angle")
         else:
             est_angle = 0
 
-        for i in np.unique(labels)[np.unique(labels)!=0]:
-            coords_min = np.min(np.where(labels == i), -1)
-            coords_max = np.max(np.where(labels == i), -1)
-                            # xmin, ymin, xmax, ymax, class
-            bbox_list.append([coords_min[1], coords_min[0], coords_max[1], coords_max[0], classes[i-1]])
+        bbox_list = extract_bboxes(labels, classes)
 
 
 
@@ -142,129 +99,140 @@ def perform_dws(predict_dict,cutoff=0,min_ccoponent_size=0, config=None,  fatten
 
 
 
+def perform_dws_batch(energy_stack, cutoff=0, min_ccoponent_size=0, fatten_cutoff=1, config=None, num_workers=None):
+    """
+    Runs perform_dws on a stack of energy maps, the maps are processed in parallel by a thread pool
+    (the opencv and scipy parts release the GIL).
+    inputs:
+        energy_stack - (B, H, W) array of energy maps (argmax over the energy levels), a single (H, W) map is also accepted
+        cutoff, min_ccoponent_size, fatten_cutoff, config - see perform_dws
+        num_workers - number of threads, defaults to one per map up to the number of cpus
+    returns:
+        bbox_lists - list of length B, each an (N, 5) array as returned by perform_dws
+    """
+    energy_stack = np.asarray(energy_stack)
+    if energy_stack.ndim == 2:
+        energy_stack = np.expand_dims(energy_stack, 0)
+
+    if num_workers is None:
+        num_workers = min(len(energy_stack), os.cpu_count() or 1)
+
+    def dws_single(energy):
+        return perform_dws({"stamp_energy": energy}, cutoff, min_ccoponent_size, config, fatten_cutoff)
+
+    if num_workers <= 1 or len(energy_stack) <= 1:
+        return [dws_single(energy) for energy in energy_stack]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(dws_single, energy_stack))
+
+
+def label_components(binary):
+    """
+    Connected components of a binary uint8 image together with the pixel count of every label.
+    Uses opencv when available and falls back to the numpy union find otherwise.
+    returns:
+        retval - number of labels including background
+        labels - int32 label image, 0 is background
+        areas - number of pixels per label
+    """
+    if cv2 is not None:
+        retval, labels, stats, _ = cv2.connectedComponentsWithStats(binary)
+        return retval, labels, stats[:, cv2.CC_STAT_AREA]
+    retval, labels = find_connected_comp(binary)
+    return retval, labels, np.bincount(labels.ravel(), minlength=retval)
+
+
+def filter_small_components(labels, sizes, min_ccoponent_size):
+    """
+    Removes all components smaller than min_ccoponent_size from a label image with a single lookup table pass.
+    inputs:
+        labels - label image as returned by cv2.connectedComponents, 0 is background
+        sizes - number of pixels per label, indexed by label (e.g. the area column of the cc stats or a bincount)
+        min_ccoponent_size - components with fewer pixels are set to background
+    returns:
+        labels - the filtered label image, surviving components keep their label
+    """
+    lut = np.arange(len(sizes), dtype=labels.dtype)
+    lut[np.asarray(sizes) < min_ccoponent_size] = 0
+    lut[0] = 0
+    return lut[labels]
+
+
+def split_fused_components(labels, labels_0, retval_0):
+    """
+    Grows the seed components in labels to the "fattened" components in labels_0. Components at the fatten cutoff
+    which contain exactly one seed take over its label, components which contain several seeds (fused symbols) are
+    split by assigning each pixel to the seed that is nearest in Manhattan distance, components without seed stay background.
+    inputs:
+        labels - label image of the seed components (after size filtering), 0 is background
+        labels_0 - label image of the components at the fatten cutoff, every seed lies inside one of them
+        retval_0 - number of labels in labels_0 (including background)
+    returns:
+        labels - the fattened label image
+    """
+    # which seeds lie inside which fattened component, computed from all pixels at once
+    overlap = (labels_0 != 0) & (labels != 0)
+    base = np.int64(labels.max()) + 1
+    pairs = np.unique(labels_0[overlap] * base + labels[overlap])
+    comp_of_pair = pairs // base
+    seed_of_pair = pairs % base
+    nr_seeds = np.bincount(comp_of_pair, minlength=retval_0)
+
+    # replace pure components
+    lut = np.zeros(retval_0, dtype=labels.dtype)
+    pure = nr_seeds == 1
+    lut[comp_of_pair[pure[comp_of_pair]]] = seed_of_pair[pure[comp_of_pair]]
+    labels = np.where(pure[labels_0], lut[labels_0], labels)
+
+    # deal with fused components
+    fused = np.where(nr_seeds > 1)[0]
+    if len(fused) > 0:
+        slices = ndimage.find_objects(labels_0)
+        for i in fused:
+            patch = labels[slices[i - 1]]
+            comp_mask = labels_0[slices[i - 1]] == i
+            # multi-source taxicab distance transform, the indices point to the nearest seed pixel
+            _, nearest = ndimage.distance_transform_cdt(~(comp_mask & (patch != 0)), metric='taxicab',
+                                                        return_indices=True)
+            patch[comp_mask] = patch[nearest[0], nearest[1]][comp_mask]
+
+    return labels
+
+
+def extract_bboxes(labels, classes):
+    """
+    Computes the bounding boxes of all labels in a single scan over the label image.
+    inputs:
+        labels - label image, 0 is background
+        classes - class of each label, classes[i-1] belongs to label i
+    returns:
+        bbox_list - (N, 5) array with one row xmin, ymin, xmax, ymax, class per present label, ordered by label
+    """
+    slices = ndimage.find_objects(labels)
+    present = np.array([ix for ix, sl in enumerate(slices) if sl is not None], dtype=np.int64)
+    bbox_list = np.zeros((len(present), 5))
+    for row, ix in enumerate(present):
+        bbox_list[row, :4] = [slices[ix][1].start, slices[ix][0].start, slices[ix][1].stop - 1, slices[ix][0].stop - 1]
+    if len(present) > 0:
+        bbox_list[:, 4] = np.asarray(classes)[present]
+    return bbox_list
+
+
 def get_class(component,class_map):
     return None
 
 def get_bbox(component,):
     return None
 
-#
-# Implements 8-connectivity connected component labeling
-#
-# Algorithm obtained from "Optimizing Two-Pass Connected-Component Labeling
-# by Kesheng Wu, Ekow Otoo, and Kenji Suzuki
-#
-def find_connected_comp(input):
-    data = input
-    width, height = input.shape
-
-    # Union find data structure
-    uf = UFarray()
-
-    #
-    # First pass
-    #
-
-    # Dictionary of point:label pairs
-    labels = {}
-
-    for y, x in product(range(height), range(width)):
-
-        #
-        # Pixel names were chosen as shown:
-        #
-        #   -------------
-        #   | a | b | c |
-        #   -------------
-        #   | d | e |   |
-        #   -------------
-        #   |   |   |   |
-        #   -------------
-        #
-        # The current pixel is e
-        # a, b, c, and d are its neighbors of interest
-        #
-        # 255 is white, 0 is black
-        # White pixels part of the background, so they are ignored
-        # If a pixel lies outside the bounds of the image, it default to white
-        #
-
-        # If the current pixel is white, it's obviously not a component...
-        if data[x, y] == 255:
-            pass
-
-        # If pixel b is in the image and black:
-        #    a, d, and c are its neighbors, so they are all part of the same component
-        #    Therefore, there is no reason to check their labels
-        #    so simply assign b's label to e
-        elif y > 0 and data[x, y - 1] == 0:
-            labels[x, y] = labels[(x, y - 1)]
-
-        # If pixel c is in the image and black:
-        #    b is its neighbor, but a and d are not
-        #    Therefore, we must check a and d's labels
-        elif x + 1 < width and y > 0 and data[x + 1, y - 1] == 0:
-
-            c = labels[(x + 1, y - 1)]
-            labels[x, y] = c
-
-            # If pixel a is in the image and black:
-            #    Then a and c are connected through e
-            #    Therefore, we must union their sets
-            if x > 0 and data[x - 1, y - 1] == 0:
-                a = labels[(x - 1, y - 1)]
-                uf.union(c, a)
-
-            # If pixel d is in the image and black:
-            #    Then d and c are connected through e
-            #    Therefore we must union their sets
-            elif x > 0 and data[x - 1, y] == 0:
-                d = labels[(x - 1, y)]
-                uf.union(c, d)
-
-        # If pixel a is in the image and black:
-        #    We already know b and c are white
-        #    d is a's neighbor, so they already have the same label
-        #    So simply assign a's label to e
-        elif x > 0 and y > 0 and data[x - 1, y - 1] == 0:
-            labels[x, y] = labels[(x - 1, y - 1)]
-
-        # If pixel d is in the image and black
-        #    We already know a, b, and c are white
-        #    so simpy assign d's label to e
-        elif x > 0 and data[x - 1, y] == 0:
-            labels[x, y] = labels[(x - 1, y)]
-
-        # All the neighboring pixels are white,
-        # Therefore the current pixel is a new component
-        else:
-            labels[x, y] = uf.makeLabel()
-
-    #
-    # Second pass
-    #
-
-    uf.flatten()
-
-    colors = {}
-
-    # Image to display the components in a nice, colorful way
-    output_img = Image.new("RGB", (width, height))
-    outdata = output_img.load()
-
-    for (x, y) in labels:
-
-        # Name of the component the current point belongs to
-        component = uf.find(labels[(x, y)])
-
-        # Update the labels with correct information
-        labels[(x, y)] = component
-
-        # Associate a random color with this component
-        if component not in colors:
-            colors[component] = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-
-        # Colorize the image
-        outdata[x, y] = colors[component]
-
-    return (labels, output_img)
\ No newline at end of file
+def find_connected_comp(input, connectivity=8):
+    """
+    Pure numpy connected component labeling, used when opencv is not available.
+    inputs:
+        input - binary image, non zero pixels are foreground
+        connectivity - 4 or 8
+    returns:
+        retval - number of labels including background
+        labels - int32 label image
+    """
+    return connected_components(input, connectivity)
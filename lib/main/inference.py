@@ -9,9 +9,13 @@ sys.path.insert(0, os.path.dirname(__file__)[:-4])
 import pdb
 from datasets.factory import get_imdb
 from main.dws_detector import DWSDetector
+from datasets.detection_store import DetectionStore
 #from main.config import cfg
 import time
 import datetime
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def main(parsed, model_dir, do_debug= False):
@@ -25,7 +29,8 @@ def main(parsed, model_dir, do_debug= False):
         all_boxes = test_net(False, parsed, do_debug)
 
 
-def test_net(net, imdb, parsed, path, debug=False, show_imgs=False):
+def test_net(net, imdb, parsed, path, debug=False, show_imgs=False, decode_workers=2, post_workers=2, queue_size=8,
+             forward_batch=1, max_pixels=3837*2713, tile_size=2048, overlap=256, stream_eval=False):
     """
     This function does inference on the images
     Parameters:
@@ -34,87 +39,239 @@ def test_net(net, imdb, parsed, path, debug=False, show_imgs=False):
         parsed - parameters passed from the argparser
         path - the path (string format) for the location of the net
         debug - set it to true if the inference has been already done, and you just want to load the values. Used for debugging purposes.
+        decode_workers - number of threads loading and rescaling images
+        post_workers - number of threads running the watershed post-processing
+        queue_size - maximal number of images waiting between two stages
+        forward_batch - number of images per forward pass, pages are bucketed by size and padded
+        max_pixels - pages with more pixels are run in overlapping tiles of tile_size with the given overlap
+        stream_eval - match the detections of every image to the ground truth right away instead of keeping them,
+                      no detections.npz is written and None is returned
+    returns:
+        detections - DetectionStore with the detections of all images
     """
     output_dir = os.path.join(parsed.out_dir, parsed.test_set)
     num_images = len(imdb.image_index)
-    all_boxes = [[[[] for _ in range(num_images)]
-                 for _ in range(imdb.num_classes)] for _ in range(parsed.paired_data)]
+    detections = DetectionStore(num_images, imdb.num_classes, parsed.paired_data)
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    det_file = os.path.join(output_dir, 'detections.pkl')
+    det_file = os.path.join(output_dir, 'detections.npz')
 
     print(num_images)
 
-    total_time = []
-    if not debug:
-        for i in range(num_images):
-            start_time = time.time()
-            if i%500 == 0:
-                print(i)
-            if "DeepScores" in path:
-                im = Image.open(imdb.image_path_at(i)).convert('L')
-            else:
-                if parsed.paired_data > 1:
-                    # hacky only for macrophages
-                    im_1 = Image.open(imdb.image_path_at(i))
-                    im_1 = np.array(im_1, dtype=np.float32) / 256
+    evaluators = None
+    if stream_eval:
+        evaluators = [imdb.streaming_evaluator(pa) for pa in range(parsed.paired_data)]
 
-                    im_2 = Image.open(imdb.image_path_at(i).replace("DAPI", "mCherry"))
-                    im_2 = np.array(im_2, dtype=np.float32) / 256
+    total_time = []
+    if evaluators is not None:
+        start_time = time.time()
+        for i, im, boxes in inference_pipeline(net, imdb, parsed, path, decode_workers, post_workers, queue_size,
+                                               forward_batch, max_pixels, tile_size, overlap):
+            if show_imgs:
+                net.save_images(parsed, im, boxes, None, False, index=i)
 
-                    im = np.stack([im_1, im_2, np.zeros(im_1.shape)], -1)
+            # only the boxes of this image are sorted by class and handed to the evaluators
+            image_boxes = rescale_boxes(boxes, parsed)
+            for pa in range(parsed.paired_data):
+                classes = image_boxes[pa][:, 4]
+                evaluators[pa].add_image(i, [image_boxes[pa][classes == c] for c in range(imdb.num_classes)])
 
+            if i%500 == 0:
+                print(i)
+                for pa in range(parsed.paired_data):
+                    print('partial mAP of pair {} at overlap {}: {:.4f}'.format(
+                        pa, evaluators[pa].ovthresh_list[0], evaluators[pa].mean_ap()[0]))
+            end_time = time.time()
+            total_time.append(end_time - start_time)
+            start_time = end_time
+        print(sum(total_time))
 
-                else:
-                    im = Image.open(imdb.image_path_at(i))
+        print('Evaluating detections')
+        for i1 in range(len(evaluators)):
+            imdb.evaluate_streaming(evaluators[i1], output_dir+"/"+str(i1), path, i1)
+        return None
 
-            im = np.asanyarray(im)
-            im = cv2.resize(im, None, None, fx=parsed.scale_list[0], fy=parsed.scale_list[0], interpolation=cv2.INTER_LINEAR)
-            if im.shape[0]*im.shape[1]>3837*2713:
-                continue
+    if not debug:
+        start_time = time.time()
+        for i, im, boxes in inference_pipeline(net, imdb, parsed, path, decode_workers, post_workers, queue_size,
+                                               forward_batch, max_pixels, tile_size, overlap):
+            if i%500 == 0:
+                print(i)
 
-            boxes = net.classify_img(im, 7, 10)
             if show_imgs:
-                net.save_images(parsed, im, boxes, None, False)
+                net.save_images(parsed, im, boxes, None, False, index=i)
 
-            # degenerate?
-            if len(boxes) > 800:
-                boxes = []
+            image_boxes = rescale_boxes(boxes, parsed)
             for pa in range(parsed.paired_data):
-                for j in range(len(boxes[pa])):
-                    # invert scaling for Boxes
-                    boxes[pa][j] = np.array(boxes[pa][j])
-                    boxes[pa][j][:-1] = (boxes[pa][j][:-1] * (1 / parsed.scale_list[0])).astype(np.int)
-
-                    class_of_symbol = boxes[pa][j][4].astype(np.int)
-                    all_boxes[pa][class_of_symbol][i].append(np.array(boxes[pa][j]))
+                detections.add(i, image_boxes[pa], pa)
             end_time = time.time()
             total_time.append(end_time - start_time)
+            start_time = end_time
         print(total_time)
         sum_time = 0
         for t in total_time: sum_time += t
         print(sum_time)
 
-        # convert to np array
-        for i1 in range(len(all_boxes)):
-            for i2 in range(len(all_boxes[i1])):
-                    for i3 in range(len(all_boxes[i1][i2])):
-                        all_boxes[i1][i2][i3] = np.asarray(all_boxes[i1][i2][i3])
-
-        # inspect all_boxes variable
-        with open(det_file, 'wb') as f:
-            pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
+        detections.save(det_file)
 
     else:
-        with open(det_file, "rb") as f:
-            all_boxes = pickle.load(f)
+        detections = DetectionStore.load(det_file)
 
     print('Evaluating detections')
-    for i1 in range(len(all_boxes)):
-        imdb.evaluate_detections(all_boxes[i1], output_dir+"/"+str(i1), path, i1)
-    return all_boxes
+    for i1 in range(detections.paired_data):
+        imdb.evaluate_detections(detections.all_boxes(i1), output_dir+"/"+str(i1), path, i1)
+    return detections
+
+
+def load_image(imdb, parsed, path, i):
+    """
+    Loads and rescales image i of the imdb.
+    returns:
+        im - the image as ndarray
+    """
+    if "DeepScores" in path:
+        im = Image.open(imdb.image_path_at(i)).convert('L')
+    else:
+        if parsed.paired_data > 1:
+            # hacky only for macrophages
+            im_1 = Image.open(imdb.image_path_at(i))
+            im_1 = np.array(im_1, dtype=np.float32) / 256
+
+            im_2 = Image.open(imdb.image_path_at(i).replace("DAPI", "mCherry"))
+            im_2 = np.array(im_2, dtype=np.float32) / 256
+
+            im = np.stack([im_1, im_2, np.zeros(im_1.shape)], -1)
+
+
+        else:
+            im = Image.open(imdb.image_path_at(i))
+
+    im = np.asanyarray(im)
+    im = cv2.resize(im, None, None, fx=parsed.scale_list[0], fy=parsed.scale_list[0], interpolation=cv2.INTER_LINEAR)
+    return im
+
+
+def rescale_boxes(boxes, parsed):
+    """
+    Rescales the boxes of an image to the original image size.
+    returns:
+        image_boxes - per pair an (N, 5) array with rows x1, y1, x2, y2, class
+    """
+    image_boxes = []
+    for pa in range(parsed.paired_data):
+        pair_boxes = np.array(boxes[pa], dtype=np.float64).reshape(-1, 5)
+        # invert scaling for Boxes
+        pair_boxes[:, :4] = (pair_boxes[:, :4] * (1 / parsed.scale_list[0])).astype(int)
+        image_boxes.append(pair_boxes)
+    return image_boxes
+
+
+def inference_pipeline(net, imdb, parsed, path, decode_workers=2, post_workers=2, queue_size=8, forward_batch=1,
+                       max_pixels=3837*2713, tile_size=2048, overlap=256, cutoff=7, min_ccoponent_size=10):
+    """
+    Runs image decoding, the network and the watershed post-processing as three concurrent stages connected by
+    bounded queues. Decoding and post-processing use thread pools, the network runs in its own thread.
+    Parameters:
+        net - the DWSDetector
+        decode_workers - number of threads loading and rescaling images
+        post_workers - number of threads running the post-processing
+        queue_size - maximal number of images waiting between two stages
+        forward_batch - number of images per forward pass, batches larger than one use DWSDetector.predict_batch
+        max_pixels - images with more pixels are run in tiles of tile_size with the given overlap
+    yields:
+        (i, im, boxes) in image order
+    """
+    num_images = len(imdb.image_index)
+    decoded = queue.Queue(maxsize=queue_size)
+    forwarded = queue.Queue(maxsize=queue_size)
+    decode_pool = ThreadPoolExecutor(max_workers=decode_workers)
+    post_pool = ThreadPoolExecutor(max_workers=post_workers)
+    # set by the consumer when it stops, the stages then give up waiting on the queues
+    stop = threading.Event()
+
+    def put(q, item):
+        """ Puts item into q, returns False if the consumer stopped before there was room """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        """ Next item of q, None if the consumer stopped """
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def decode_stage():
+        try:
+            for i in range(num_images):
+                if not put(decoded, (i, decode_pool.submit(load_image, imdb, parsed, path, i))):
+                    return
+        except RuntimeError:
+            # the consumer stopped and shut the pool down
+            return
+        put(decoded, None)
+
+    def forward_stage():
+        try:
+            done = False
+            while not done:
+                # collect up to forward_batch decoded images
+                batch = []
+                while len(batch) < forward_batch:
+                    item = get(decoded)
+                    if item is None:
+                        done = True
+                        break
+                    i, im_future = item
+                    batch.append((i, im_future.result()))
+
+                fitting = [im for _, im in batch if im.shape[0]*im.shape[1] <= max_pixels]
+                if forward_batch == 1:
+                    preds = [net.predict(im) for im in fitting]
+                else:
+                    preds = net.predict_batch(fitting) if len(fitting) > 0 else []
+
+                for i, im in batch:
+                    if im.shape[0]*im.shape[1] > max_pixels:
+                        # too large for a single forward pass
+                        pred_dicts = net.predict_tiled(im, tile_size, overlap)
+                    else:
+                        pred_dicts = preds.pop(0)
+                    if not put(forwarded, (i, im, post_pool.submit(net.post_process, pred_dicts, cutoff,
+                                                                   min_ccoponent_size))):
+                        return
+        except Exception as e:
+            # hand the error to the consumer
+            put(forwarded, e)
+        put(forwarded, None)
+
+    stages = [threading.Thread(target=decode_stage), threading.Thread(target=forward_stage)]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+
+    try:
+        while True:
+            item = forwarded.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            i, im, post_future = item
+            yield i, im, post_future.result()
+    finally:
+        stop.set()
+        decode_pool.shutdown(wait=False)
+        post_pool.shutdown(wait=False)
 
 
 if __name__ == '__main__':
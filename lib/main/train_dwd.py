@@ -13,6 +13,7 @@ from tensorflow.contrib import slim
 from utils.safe_softmax_wrapper import safe_softmax_cross_entropy_with_logits
 import roi_data_layer.roidb as rdl_roidb
 from roi_data_layer.layer import RoIDataLayer
+from roi_data_layer.roidb_store import RoidbStore
 #from utils.prefetch_wrapper import PrefetchWrapper
 from utils.prefetch_wrapper_cache import PrefetchWrapperCache as PrefetchWrapper
 
@@ -973,7 +974,14 @@ def get_checkpoint_dir(args):
 
 
 def get_training_roidb(imdb, use_flipped):
-    """Returns a roidb (Region of Interest database) for use in training."""
+    """Returns a roidb (Region of Interest database) for use in training.
+
+    The roidb is always loaded, flipped and prepared, so the imdb is in the same state whether the store is
+    built or not. The data layers read it from a memory mapped RoidbStore in the cache directory, which is
+    only written again when the annotations or the gt roidb cache change.
+    """
+    # the fingerprint is taken before the gt roidb is loaded, an annotation edited in between rebuilds the next time
+    fingerprint = imdb.annotation_fingerprint()
     if use_flipped:
         print('Appending horizontally-flipped training examples...')
         imdb.append_flipped_images()
@@ -983,7 +991,10 @@ def get_training_roidb(imdb, use_flipped):
     rdl_roidb.prepare_roidb(imdb)
     print('done')
 
-    return imdb.roidb
+    cache_dir = os.path.join(imdb.cache_path, imdb.name + '_roidb_store' + ('_flipped' if use_flipped else ''))
+    source = os.path.join(imdb.cache_path, imdb.name + '_gt_roidb.pkl')
+    return RoidbStore.cached(cache_dir, lambda: imdb.roidb, imdb.num_classes, source=source,
+                             num_images=imdb.num_images, fingerprint=fingerprint)
 
 
 def save_objectness_function_handles(args):
@@ -1026,7 +1037,8 @@ def load_database(args):
 
     if args.dataset_validation != "no":
         print("Setting up validation image database: " + args.dataset_validation)
-        imdb_val = get_imdb(args,args.dataset_validation)
+        # the training imdb is modified (flipped images), validation on the same dataset needs its own instance
+        imdb_val = get_imdb(args,args.dataset_validation, cached=args.dataset_validation != args.dataset)
         print('Loaded dataset `{:s}` for validation'.format(imdb_val.name))
         roidb_val = get_training_roidb(imdb_val, False)
         print('{:d} roidb entries'.format(len(roidb_val)))
@@ -144,3 +144,25 @@ def build_dwd_net(input,model,num_classes,pretrained_dir, max_energy,individual_
     #         return network_heads_list, init_fn
 
 
+def compact_energy_output(energy_logits, cutoffs=None):
+    """
+    Reduces the logits of a softmax energy head on the graph to what the watershed post-processing needs,
+    so no float tensor of shape (batch, height, width, max_energy) has to be fetched.
+    inputs:
+        energy_logits - logits of the energy head
+        cutoffs - None to get the energy levels, otherwise a list of increasing cutoffs. Each pixel then holds the
+                  number of cutoffs its energy exceeds, for a single cutoff this is a binary mask.
+    returns:
+        uint8 tensor of shape (batch, height, width)
+    """
+    levels = tf.cast(tf.argmax(energy_logits, axis=-1), tf.int32)
+    if cutoffs is None:
+        return tf.cast(levels, tf.uint8)
+
+    assert all(low < high for low, high in zip(cutoffs[:-1], cutoffs[1:])), \
+        'energy cutoffs have to be strictly increasing, got {}'.format(cutoffs)
+
+    compact = tf.zeros_like(levels)
+    for cutoff in cutoffs:
+        compact += tf.cast(levels > cutoff, tf.int32)
+    return tf.cast(compact, tf.uint8)
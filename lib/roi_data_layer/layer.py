@@ -22,7 +22,7 @@ class RoIDataLayer(object):
   """Fast R-CNN data layer used for training."""
 
   def __init__(self, roidb, num_classes, random=False, augmentation='none'):
-    """Set the roidb to be used by this layer during training."""
+    """Set the roidb (a list of roidb dicts or a RoidbStore) to be used by this layer during training."""
     self._roidb = roidb
     self._num_classes = num_classes
     # Also set a random flag
@@ -66,7 +66,7 @@ def get_minibatch(roidb, args, assign, helper, ignore_symbols=0, visualize=0, au
         scalings = None
         sub_batch = []
         # put in list for paired 1
-        if roidb_ele.__class__ == dict().__class__:
+        if not isinstance(roidb_ele, list):
             roidb_ele = [roidb_ele]
         for nr_subele, roidb_subele in enumerate(roidb_ele):
             #print( roidb_subele)
@@ -89,7 +89,8 @@ def get_minibatch(roidb, args, assign, helper, ignore_symbols=0, visualize=0, au
                 gt_inds = np.where(roidb_subele['gt_classes'] != 0)[0]
             else:
                 # For the COCO ground truth boxes, exclude the  ones that are ''iscrowd''
-                gt_inds = np.where(roidb_subele['gt_classes'] != 0 & np.all(roidb_subele['gt_overlaps'].toarray() > -1.0, axis=1))[0]
+                # (the crowd test was bound as `0 & ...` and never applied, only the class test selects boxes)
+                gt_inds = np.where(roidb_subele['gt_classes'] != 0)[0]
 
             #gt_boxes = np.empty((len(gt_inds), 9), dtype=np.float32)
             gt_boxes = [[[None],None,[None]] for i in range(len(gt_inds))]
@@ -14,7 +14,7 @@ import numpy as np
 #from main.config import cfg
 from main.bbox_transform import bbox_transform
 from utils.bbox import bbox_overlaps
-import PIL
+from datasets.ds_utils import max_overlap_fields
 
 def prepare_roidb(imdb):
   """Enrich the imdb's roidb by adding some derived quantities that
@@ -25,51 +25,37 @@ def prepare_roidb(imdb):
   """
   roidb = imdb.roidb
   if not (imdb.name.startswith('coco')):
-    sizes = [PIL.Image.open(imdb.image_path_at(i)).size
-         for i in range(imdb.num_images)]
+    sizes = imdb.image_sizes()
+  all_max_classes = []
+  all_max_overlaps = []
   for i in range(len(imdb.image_index)):
     if not (imdb.name.startswith('macrophages')):
+      entries = [roidb[i]]
       roidb[i]['image'] = imdb.image_path_at(i)
-      if not (imdb.name.startswith('coco')):
-        roidb[i]['width'] = sizes[i][0]
-        roidb[i]['height'] = sizes[i][1]
-      # need gt_overlaps as a dense array for argmax
-      gt_overlaps = roidb[i]['gt_overlaps'].toarray()
-      # max overlap with gt over classes (columns)
-      max_overlaps = gt_overlaps.max(axis=1)
-      # gt class that had the max overlap
-      max_classes = gt_overlaps.argmax(axis=1)
-      roidb[i]['max_classes'] = max_classes
-      roidb[i]['max_overlaps'] = max_overlaps
-      # sanity checks
-      # max overlap of 0 => class should be zero (background)
-      zero_inds = np.where(max_overlaps == 0)[0]
-      assert all(max_classes[zero_inds] == 0)
-      # max overlap > 0 => class should not be zero (must be a fg class)
-      nonzero_inds = np.where(max_overlaps > 0)[0]
-      #assert all(max_classes[nonzero_inds] != 0)
     else:
       #support paired datasets
-      for nr, i_roidb in enumerate(roidb[i]):
+      entries = roidb[i]
+      for nr, i_roidb in enumerate(entries):
         if nr == 0:
           i_roidb['image'] = imdb.image_path_at(i)
         else:
           i_roidb['image'] = imdb.image_path_at(i).replace("DAPI","mCherry")
-        if not (imdb.name.startswith('coco')):
-          i_roidb['width'] = sizes[i][0]
-          i_roidb['height'] = sizes[i][1]
-        # need gt_overlaps as a dense array for argmax
-        gt_overlaps = i_roidb['gt_overlaps'].toarray()
-        # max overlap with gt over classes (columns)
-        max_overlaps = gt_overlaps.max(axis=1)
-        # gt class that had the max overlap
-        max_classes = gt_overlaps.argmax(axis=1)
-        i_roidb['max_classes'] = max_classes
-        i_roidb['max_overlaps'] = max_overlaps
-        # sanity checks
-        # max overlap of 0 => class should be zero (background)
-        zero_inds = np.where(max_overlaps == 0)[0]
-        assert all(max_classes[zero_inds] == 0)
-        # max overlap > 0 => class should not be zero (must be a fg class)
-        nonzero_inds = np.where(max_overlaps > 0)[0]
-        # assert all(max_classes[nonzero_inds] != 0)
\ No newline at end of file
+    for i_roidb in entries:
+      if not (imdb.name.startswith('coco')):
+        i_roidb['width'] = sizes[i][0]
+        i_roidb['height'] = sizes[i][1]
+      # max overlap with gt over classes and the gt class that had the max overlap,
+      # read from gt_classes or the sparse gt_overlaps without densifying it
+      max_classes, max_overlaps = max_overlap_fields(i_roidb)
+      i_roidb['max_classes'] = max_classes
+      i_roidb['max_overlaps'] = max_overlaps
+      all_max_classes.append(max_classes)
+      all_max_overlaps.append(max_overlaps)
+
+  # sanity checks over the whole roidb
+  max_classes = np.concatenate([np.zeros(0, dtype=np.int64)] + all_max_classes)
+  max_overlaps = np.concatenate([np.zeros(0, dtype=np.float32)] + all_max_overlaps)
+  # max overlap of 0 => class should be zero (background)
+  assert np.all(max_classes[max_overlaps == 0] == 0)
+  # max overlap > 0 => class should not be zero (must be a fg class)
+  #assert np.all(max_classes[max_overlaps > 0] != 0)
@@ -0,0 +1,247 @@
+# --------------------------------------------------------
+# Columnar memory mapped roidb
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""A prepared roidb in flat arrays, memory mapped from the cache directory so
+that the data layer processes share its pages through the OS cache."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from collections.abc import MutableMapping
+import numpy as np
+import scipy.sparse
+from datasets.gt_index import read_fingerprint, write_fingerprint
+
+
+class RoidbStore(object):
+  """
+  Roidb entries in flat arrays. The per object fields of all entries are
+  concatenated, the objects of entry e are the rows
+  object_offsets[e]:object_offsets[e + 1]. Paired datasets store the entries
+  of image i at i * paired ... (i + 1) * paired - 1. store[i] is a
+  RoidbEntry (a list of them for paired data) that can be used like the
+  roidb dict. gt_overlaps is not stored, entries that had it rebuild it
+  from max_classes and max_overlaps, from_roidb refuses overlaps that are
+  not one-hot. Keys that are not listed below are refused as well.
+  """
+  # per object arrays
+  OBJECT_KEYS = ['boxes', 'boxes_full', 'gt_classes', 'seg_areas', 'max_classes', 'max_overlaps']
+  # one value per entry and the value stored for entries without it (or with None)
+  ENTRY_DEFAULTS = {'image': '', 'width': 0, 'height': 0, 'flipped': False, 'semseg_path': ''}
+  ENTRY_KEYS = list(ENTRY_DEFAULTS)
+  # a list of strings per entry
+  LIST_KEYS = ['objseg_path']
+
+  def __init__(self, arrays, cache_dir=None):
+    self.arrays = arrays
+    self.cache_dir = cache_dir
+    self.object_offsets = arrays['object_offsets']
+    self.num_classes = int(arrays['num_classes'])
+    self.paired = int(arrays['paired'])
+
+  def __len__(self):
+    return (len(self.object_offsets) - 1) // self.paired
+
+  def __getitem__(self, i):
+    if self.paired == 1:
+      return RoidbEntry(self, i)
+    return [RoidbEntry(self, i * self.paired + nr) for nr in range(self.paired)]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __getstate__(self):
+    # memory mapped stores are reopened instead of copied into other processes
+    if self.cache_dir is not None:
+      return {'cache_dir': self.cache_dir}
+    return {'arrays': self.arrays}
+
+  def __setstate__(self, state):
+    if 'cache_dir' in state:
+      self.__init__(self.load_arrays(state['cache_dir']), state['cache_dir'])
+    else:
+      self.__init__(state['arrays'])
+
+  def has(self, key, row):
+    return key in self.arrays and bool(self.arrays['has_' + key][row])
+
+  def keys_at(self, row):
+    keys = [key for key in self.OBJECT_KEYS + self.ENTRY_KEYS + self.LIST_KEYS if self.has(key, row)]
+    if 'has_gt_overlaps' in self.arrays and self.arrays['has_gt_overlaps'][row]:
+      keys.append('gt_overlaps')
+    return keys
+
+  def value_at(self, key, row):
+    """ Value of key in entry row, as it was in the roidb dict """
+    if key == 'gt_overlaps' and 'gt_overlaps' in self.keys_at(row):
+      return self.gt_overlaps_at(row)
+    if not self.has(key, row):
+      raise KeyError(key)
+    if key in self.OBJECT_KEYS:
+      return self.arrays[key][self.object_offsets[row]:self.object_offsets[row + 1]]
+    if key in self.LIST_KEYS:
+      offsets = self.arrays[key + '_offsets']
+      return self.arrays[key][offsets[row]:offsets[row + 1]].tolist()
+    if 'none_' + key in self.arrays and self.arrays['none_' + key][row]:
+      return None
+    return self.arrays[key][row].item()
+
+  def gt_overlaps_at(self, row):
+    return overlaps_from_max(self.value_at('max_classes', row), self.value_at('max_overlaps', row), self.num_classes)
+
+  @classmethod
+  def from_roidb(cls, roidb, num_classes):
+    """
+    Builds the store from a prepared roidb
+    inputs:
+      roidb - list of roidb dicts, or of lists of dicts for paired data
+      num_classes - number of classes of the imdb, the width of gt_overlaps
+    """
+    paired = len(roidb[0]) if len(roidb) > 0 and isinstance(roidb[0], list) else 1
+    entries = [entry for roidb_entry in roidb for entry in (roidb_entry if paired > 1 else [roidb_entry])]
+    known = set(cls.OBJECT_KEYS + cls.ENTRY_KEYS + cls.LIST_KEYS + ['gt_overlaps'])
+    for e, entry in enumerate(entries):
+      unknown = set(entry) - known
+      if unknown:
+        raise ValueError('roidb entry {} has keys the RoidbStore does not store: {}'.format(e, sorted(unknown)))
+      if 'gt_overlaps' in entry:
+        if 'max_classes' not in entry or 'max_overlaps' not in entry:
+          raise ValueError('roidb entry {} has gt_overlaps but no max_classes / max_overlaps, run prepare_roidb'.format(e))
+        rebuilt = overlaps_from_max(entry['max_classes'], entry['max_overlaps'], num_classes)
+        if (rebuilt != scipy.sparse.csr_matrix(entry['gt_overlaps'], dtype=np.float32)).nnz > 0:
+          raise ValueError('gt_overlaps of roidb entry {} are not one-hot and can not be stored'.format(e))
+    counts = [len(entry['gt_classes']) for entry in entries]
+    arrays = {'object_offsets': np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+              'num_classes': np.array(num_classes), 'paired': np.array(paired)}
+
+    for key in cls.OBJECT_KEYS:
+      present = [key in entry for entry in entries]
+      if not any(present):
+        continue
+      template = np.asarray(next(entry[key] for entry in entries if key in entry))
+      parts = [np.asarray(entry[key], dtype=template.dtype) if key in entry
+               else np.zeros((count,) + template.shape[1:], dtype=template.dtype)
+               for entry, count in zip(entries, counts)]
+      arrays[key] = np.concatenate([np.zeros((0,) + template.shape[1:], dtype=template.dtype)] + parts)
+      arrays['has_' + key] = np.array(present)
+
+    arrays['has_gt_overlaps'] = np.array(['gt_overlaps' in entry for entry in entries], dtype=bool)
+
+    for key in cls.ENTRY_KEYS:
+      present = [key in entry for entry in entries]
+      if not any(present):
+        continue
+      is_none = [key in entry and entry[key] is None for entry in entries]
+      default = cls.ENTRY_DEFAULTS[key]
+      arrays[key] = np.array([default if entry.get(key) is None else entry[key] for entry in entries])
+      arrays['has_' + key] = np.array(present)
+      if any(is_none):
+        arrays['none_' + key] = np.array(is_none)
+
+    for key in cls.LIST_KEYS:
+      present = [key in entry for entry in entries]
+      if not any(present):
+        continue
+      values = [entry.get(key, []) for entry in entries]
+      arrays[key] = np.array([item for value in values for item in value], dtype=str)
+      arrays[key + '_offsets'] = np.concatenate(([0], np.cumsum([len(value) for value in values]))).astype(np.int64)
+      arrays['has_' + key] = np.array(present)
+
+    return cls(arrays)
+
+  def save(self, cache_dir):
+    """ Writes every array to a .npy file in cache_dir, object_offsets.npy is written last and marks a complete store """
+    marker = os.path.join(cache_dir, 'object_offsets.npy')
+    if os.path.exists(marker):
+      os.remove(marker)
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    for name in sorted(self.arrays, key=lambda name: name == 'object_offsets'):
+      np.save(os.path.join(cache_dir, name + '.npy'), self.arrays[name])
+
+  @staticmethod
+  def load_arrays(cache_dir):
+    return dict((name[:-4], np.load(os.path.join(cache_dir, name), mmap_mode='r'))
+                for name in os.listdir(cache_dir) if name.endswith('.npy'))
+
+  @classmethod
+  def load(cls, cache_dir):
+    """ Opens a store written by save, the arrays are memory mapped """
+    return cls(cls.load_arrays(cache_dir), cache_dir)
+
+  @classmethod
+  def cached(cls, cache_dir, roidb_fn, num_classes, source=None, num_images=None, fingerprint=None):
+    """
+    Loads the store from cache_dir or builds it from the roidb and stores it there
+    inputs:
+      cache_dir - directory of the store files
+      roidb_fn - function returning the prepared roidb, only called if the store has to be built
+      num_classes - number of classes of the imdb
+      source - file the roidb is cached in, the store is rebuilt if it is newer
+      num_images - the store is rebuilt if it has a different number of images
+      fingerprint - string identifying the annotations, the store is rebuilt if it was built from other ones
+    """
+    marker = os.path.join(cache_dir, 'object_offsets.npy')
+    if os.path.exists(marker):
+      stale = source is not None and os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(marker)
+      stale = stale or (fingerprint is not None and read_fingerprint(cache_dir) != fingerprint)
+      if not stale:
+        store = cls.load(cache_dir)
+        if num_images is None or len(store) == num_images:
+          return store
+
+    print('building roidb store {}'.format(cache_dir))
+    if os.path.exists(cache_dir):
+      for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+          os.remove(os.path.join(cache_dir, name))
+    cls.from_roidb(roidb_fn(), num_classes).save(cache_dir)
+    if fingerprint is not None:
+      write_fingerprint(cache_dir, fingerprint)
+    return cls.load(cache_dir)
+
+
+def overlaps_from_max(max_classes, max_overlaps, num_classes):
+  """ Sparse num_objs x num_classes overlaps, one-hot at max_classes, rows with negative overlap (crowd) are filled """
+  max_classes = np.asarray(max_classes)
+  max_overlaps = np.asarray(max_overlaps, dtype=np.float32)
+  overlaps = np.zeros((len(max_classes), num_classes), dtype=np.float32)
+  overlaps[np.arange(len(max_classes)), max_classes] = max_overlaps
+  crowd = max_overlaps < 0
+  overlaps[crowd] = max_overlaps[crowd][:, None]
+  return scipy.sparse.csr_matrix(overlaps)
+
+
+class RoidbEntry(MutableMapping):
+  """
+  View of one entry of a RoidbStore that behaves like its roidb dict. Values
+  that are assigned (e.g. the boxes converted by get_minibatch) are kept in
+  the view, the memory mapped arrays are never written.
+  """
+
+  def __init__(self, store, row):
+    self.store = store
+    self.row = row
+    self.overrides = {}
+
+  def __getitem__(self, key):
+    if key in self.overrides:
+      return self.overrides[key]
+    return self.store.value_at(key, self.row)
+
+  def __setitem__(self, key, value):
+    self.overrides[key] = value
+
+  def __delitem__(self, key):
+    del self.overrides[key]
+
+  def __iter__(self):
+    keys = self.store.keys_at(self.row)
+    return iter(keys + [key for key in self.overrides if key not in keys])
+
+  def __len__(self):
+    return len(list(iter(self)))
@@ -0,0 +1,66 @@
+# --------------------------------------------------------
+# Fast R-CNN
+# Copyright (c) 2015 Microsoft
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Sergey Karayev
+# --------------------------------------------------------
+
+import numpy as np
+
+try:
+    from utils.cython_bbox import bbox_overlaps as cython_bbox_overlaps
+except ImportError:
+    cython_bbox_overlaps = None
+
+
+def bbox_overlaps(boxes, query_boxes):
+    """
+    IoU of every box with every query box, uses the compiled utils.cython_bbox for float64 inputs when it is built
+    and the numpy kernel otherwise, so float32 and integer boxes are read without a float64 copy. The callers do not
+    have to convert their boxes, the arrays handed to the compiled kernel are made contiguous here.
+    inputs:
+        boxes - (N, 4) array of x1, y1, x2, y2 (inclusive pixel coordinates), any numeric dtype
+        query_boxes - (K, 4) array of x1, y1, x2, y2
+    returns:
+        overlaps - (N, K) float64 array of overlap between boxes and query_boxes
+    """
+    boxes = np.asarray(boxes)
+    query_boxes = np.asarray(query_boxes)
+    if cython_bbox_overlaps is not None and boxes.dtype == np.float64 and query_boxes.dtype == np.float64:
+        return cython_bbox_overlaps(np.ascontiguousarray(boxes, dtype=np.float64),
+                                    np.ascontiguousarray(query_boxes, dtype=np.float64))
+    return bbox_overlaps_numpy(boxes, query_boxes)
+
+
+def bbox_overlaps_numpy(boxes, query_boxes, max_elements=2 ** 22):
+    """
+    Broadcast version of the cython bbox_overlaps, the boxes are processed in chunks so that no intermediate
+    array has more than max_elements entries. The inputs are not copied, only each chunk is converted to float64.
+    inputs:
+        boxes - (N, 4) array of x1, y1, x2, y2 (inclusive pixel coordinates), any numeric dtype
+        query_boxes - (K, 4) array of x1, y1, x2, y2
+        max_elements - size bound of the N x K intermediates
+    returns:
+        overlaps - (N, K) float64 array of overlap between boxes and query_boxes
+    """
+    boxes = np.asarray(boxes)
+    query_boxes = np.asarray(query_boxes, dtype=np.float64)
+    N = boxes.shape[0]
+    K = query_boxes.shape[0]
+    overlaps = np.zeros((N, K))
+    if N == 0 or K == 0:
+        return overlaps
+
+    query_areas = (query_boxes[:, 2] - query_boxes[:, 0] + 1) * (query_boxes[:, 3] - query_boxes[:, 1] + 1)
+    chunk = max(1, max_elements // K)
+    for start in range(0, N, chunk):
+        chunk_boxes = boxes[start:start + chunk].astype(np.float64, copy=False)
+        iw = np.minimum(chunk_boxes[:, 2:3], query_boxes[:, 2]) - np.maximum(chunk_boxes[:, 0:1], query_boxes[:, 0]) + 1
+        ih = np.minimum(chunk_boxes[:, 3:4], query_boxes[:, 3]) - np.maximum(chunk_boxes[:, 1:2], query_boxes[:, 1]) + 1
+        inters = np.maximum(iw, 0, out=iw)
+        inters *= np.maximum(ih, 0, out=ih)
+        box_areas = (chunk_boxes[:, 2] - chunk_boxes[:, 0] + 1) * (chunk_boxes[:, 3] - chunk_boxes[:, 1] + 1)
+        ua = box_areas[:, None] + query_areas - inters
+        # like the cython version only boxes that intersect get an overlap, this also skips degenerate boxes
+        np.divide(inters, ua, out=overlaps[start:start + chunk], where=inters > 0)
+    return overlaps
@@ -16,21 +16,27 @@ import random
 from PIL import Image
 
 
-def im_list_to_blob(ims):
+def im_list_to_blob(ims, pad_value=0, min_shape=None):
   """Convert a list of images into a network input.
 
   Assumes images are already prepared (means subtracted, BGR order, ...).
+  Images are padded with pad_value to the largest image size, or to
+  min_shape (height, width) if that is larger.
   """
-  max_shape = np.array([im.shape for im in ims]).max(axis=0)
+  max_shape = np.array([im.shape[:2] for im in ims]).max(axis=0)
+  if min_shape is not None:
+    max_shape = np.maximum(max_shape, min_shape)
   num_images = len(ims)
   if len(ims[0].shape) == 2 :
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], 1),
-                    dtype=np.float32)
+    blob = np.full((num_images, max_shape[0], max_shape[1], 1), pad_value,
+                   dtype=np.float32)
   else:
-    blob = np.zeros((num_images, max_shape[0], max_shape[1], ims[0].shape[2]),
-                    dtype=np.float32)
+    blob = np.full((num_images, max_shape[0], max_shape[1], ims[0].shape[2]), pad_value,
+                   dtype=np.float32)
   for i in range(num_images):
     im = ims[i]
+    if len(im.shape) == 2:
+      im = im[:, :, np.newaxis]
     blob[i, 0:im.shape[0], 0:im.shape[1], :] = im
 
   return blob
@@ -1,3 +1,4 @@
+import json
 import pandas as pa
 
 def table_pickle():
@@ -28,6 +29,18 @@ def table_txt(txt_path):
     return ap_data
 
 
+def table_json(json_path):
+    """
+    Per class table of a result file written by the COCO-style evaluation (coco_eval.json)
+    """
+    with open(json_path) as f:
+        summary = json.load(f)
+
+    columns = ["Class", "AP", "AP50", "AP75", "AR"]
+    rows = [[name] + [values[x] for x in columns[1:]] for name, values in summary["classes"].items()]
+    return pa.DataFrame(rows, columns=columns)
+
+
 
 if __name__ == '__main__':
     out_dir = "/share/DeepWatershedDetection/output"
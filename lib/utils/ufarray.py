@@ -1,62 +1,88 @@
 # Array based union find data structure
 
 # P: The array, which encodes the set membership of all the elements
+#    P[i] <= i always holds, so the root of every set is its smallest element
+
+import numpy as np
+
 
 class UFarray:
-    def __init__(self):
+    def __init__(self, size=0):
         # Array which holds label -> set equivalences
-        self.P = []
-
-        # Name of the next label, when one is created
-        self.label = 0
-
-    def makeLabel(self):
-        r = self.label
-        self.label += 1
-        self.P.append(r)
-        return r
-    
-    # Makes all nodes "in the path of node i" point to root
-    def setRoot(self, i, root):
-        while self.P[i] < i:
-            j = self.P[i]
-            self.P[i] = root
-            i = j
-        self.P[i] = root
-
-    # Finds the root node of the tree containing node i
-    def findRoot(self, i):
-        while self.P[i] < i:
-            i = self.P[i]
-        return i
-    
-    # Finds the root of the tree containing node i
-    # Simultaneously compresses the tree
+        self.P = np.arange(size, dtype=np.int32)
+
+    # Makes every node point directly to its root (pointer jumping)
+    def flatten(self):
+        while True:
+            grand_parents = self.P[self.P]
+            if np.array_equal(grand_parents, self.P):
+                break
+            self.P = grand_parents
+
+    # Finds the roots of the trees containing the nodes i
     def find(self, i):
-        root = self.findRoot(i)
-        self.setRoot(i, root)
-        return root
-    
-    # Joins the two trees containing nodes i and j
-    # Modified to be less agressive about compressing paths
-    # because performance was suffering some from over-compression
+        i = np.asarray(i, dtype=np.int32)
+        while True:
+            parents = self.P[i]
+            if np.array_equal(parents, i):
+                return i
+            i = parents
+
+    # Joins the trees containing i[k] and j[k] for all k
+    # Every round hooks the larger root onto the smallest root it is connected to
+    # and compresses all paths, until all pairs share a root
     def union(self, i, j):
-        if i != j:
-            root = self.findRoot(i)
-            rootj = self.findRoot(j)
-            if root > rootj: root = rootj
-            self.setRoot(j, root)
-            self.setRoot(i, root)
-    
-    def flatten(self):
-        for i in range(1, len(self.P)):
-            self.P[i] = self.P[self.P[i]]
-    
-    def flattenL(self):
-        k = 1
-        for i in range(1, len(self.P)):
-            if self.P[i] < i:
-                self.P[i] = self.P[self.P[i]]
-            else:
-                self.P[i] = k
-                k += 1
+        i = np.asarray(i, dtype=np.int32)
+        j = np.asarray(j, dtype=np.int32)
+        while len(i) > 0:
+            root_i = self.find(i)
+            root_j = self.find(j)
+            differ = root_i != root_j
+            if not differ.any():
+                break
+            i, j = i[differ], j[differ]
+            root_i, root_j = root_i[differ], root_j[differ]
+            np.minimum.at(self.P, np.maximum(root_i, root_j), np.minimum(root_i, root_j))
+            self.flatten()
+
+
+def connected_components(image, connectivity=8):
+    """
+    Connected component labeling of a binary image with a vectorized union find.
+    Drop in replacement for cv2.connectedComponents: non zero pixels are foreground and components
+    are numbered in raster scan order of their first pixel (cv2 may number 8-connected components
+    in a different order, the components themselves are identical).
+    inputs:
+        image - 2d uint8 (or bool) image
+        connectivity - 4 or 8
+    returns:
+        retval - number of labels including the background label 0
+        labels - int32 label image of the same shape as image
+    """
+    assert connectivity in [4, 8], 'connectivity must be 4 or 8, got {}'.format(connectivity)
+    foreground = np.asarray(image) != 0
+    height, width = foreground.shape
+
+    # compact index of every foreground pixel in raster order, -1 for background
+    index = np.full(foreground.shape, -1, dtype=np.int32)
+    nr_foreground = int(foreground.sum())
+    index[foreground] = np.arange(nr_foreground, dtype=np.int32)
+
+    # neighbor offsets looking forward in raster order: right, down and for 8-connectivity the diagonals
+    offsets = [(0, 1), (1, 0)]
+    if connectivity == 8:
+        offsets += [(1, 1), (1, -1)]
+
+    uf = UFarray(nr_foreground)
+    for dy, dx in offsets:
+        a = index[0:height - dy, max(0, -dx):width - max(0, dx)]
+        b = index[dy:height, max(0, dx):width - max(0, -dx)]
+        linked = (a >= 0) & (b >= 0)
+        uf.union(a[linked], b[linked])
+    uf.flatten()
+
+    # roots are the raster-first pixel of each component, so sorted roots give the scan order
+    roots, components = np.unique(uf.P, return_inverse=True)
+    labels = np.zeros(foreground.shape, dtype=np.int32)
+    labels[foreground] = components.astype(np.int32) + 1
+    return len(roots) + 1, labels